@@ -1,29 +1,62 @@
 """Authentication API - Production ready with JWT"""
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
+from sqlalchemy import bindparam, exists, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, field_validator
 from typing import Optional
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import base64
+import hashlib
 import logging
-import bcrypt
-import jwt
+import re
+import orjson
 import os
+import time
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from app.database import get_db
+from app.core.config import settings
+from app.core.security import create_access_token, hash_password, invalidate_cached_user, verify_password
+from app.database import attach_cached, get_async_db, row_values
 from app.models.schemas import User
 
 logger = logging.getLogger("rag_education.auth")
 
 router = APIRouter(prefix="/api/auth", tags=["Authentication"])
 
-# Get settings from environment directly for reliability
-SECRET_KEY = os.environ.get("SECRET_KEY", "change-this-in-production")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 10080  # 7 days
-GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", "")
+# Google ID token verification; signing certs rotate slowly, so cache them
+# for as long as the response's Cache-Control max-age allows
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+GOOGLE_CERTS_DEFAULT_TTL = 3600  # when the response has no max-age
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+_google_certs: Optional[tuple] = None  # (certs, monotonic expiry)
+_google_request = None
+
+# Deliberately loose shape check; compiled once at import
+_EMAIL_RE = re.compile(r"^[^@\s]{1,64}@[^@\s]{1,255}\.[^@\s]{2,}$")
+
+# Statements built once so their compiled SQL is reused from the engine's cache
+# Emails are matched on lower(email), which is backed by ix_users_email_lower
+_STMT_USER_BY_EMAIL = select(User).where(func.lower(User.email) == bindparam("email"))
+_STMT_USER_EXISTS = select(exists().where(func.lower(User.email) == bindparam("email")))
+
+# Recent password verification results; per-process random key for the digests
+_verify_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+_VERIFY_CACHE_KEY = os.urandom(32)
+
+# Dedicated process pool for bcrypt, created on first use and shut down with
+# the app; the semaphore caps queued hashes during login storms
+_HASH_WORKERS = os.cpu_count() or 1
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_slots = asyncio.Semaphore(_HASH_WORKERS * 2)
+
+# Short-lived cache of User column values keyed by lowercased email.
+# Per-process only; swap for a shared cache (e.g. Redis) with multiple workers.
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
 
 
 class LoginRequest(BaseModel):
@@ -31,6 +64,11 @@ class LoginRequest(BaseModel):
     password: Optional[str] = None
     name: Optional[str] = None
 
+    @field_validator("email")
+    @classmethod
+    def normalize_email(cls, value: str) -> str:
+        return value.strip().lower()
+
 
 class GoogleAuthRequest(BaseModel):
     credential: str
@@ -42,49 +80,173 @@ class TokenResponse(BaseModel):
     user: dict
 
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+def validate_email(email: str) -> str:
+    """Return the trimmed email, or raise 400 if it is not email-shaped."""
+    email = email.strip()
+    if not _EMAIL_RE.match(email):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid email"
+        )
+    return email
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
+    """Look up a user by email, serving repeat lookups from the TTL cache."""
+    key = email.lower()
+    cached = _user_cache.get(key)
+    if cached is not None:
+        return attach_cached(db, User, cached)
+
+    result = await db.execute(_STMT_USER_BY_EMAIL, {"email": key})
+    user = result.scalar_one_or_none()
+    if user:
+        _user_cache[key] = row_values(user)
+    return user
+
+
+async def user_exists(db: AsyncSession, email: str) -> bool:
+    """Check whether an email is registered without hydrating a User row."""
+    key = email.lower()
+    if key in _user_cache:
+        return True
+    result = await db.execute(_STMT_USER_EXISTS, {"email": key})
+    return result.scalar()
+
+
+def invalidate_user_cache(email: str, user_id: Optional[int] = None) -> None:
+    """Drop a cached user after it is created or modified."""
+    _user_cache.pop(email.lower(), None)
+    if user_id is not None:
+        invalidate_cached_user(user_id)
+
+
+async def run_password_hash(fn, *args):
+    """Run a bcrypt hash/verify in the hashing process pool.
 
+    bcrypt is CPU-bound (~250ms per call); keeping it off the event loop lets
+    other requests progress while a login is being checked.
+    """
+    global _hash_pool
+    async with _hash_slots:
+        if _hash_pool is None:
+            _hash_pool = ProcessPoolExecutor(max_workers=_HASH_WORKERS)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_pool, fn, *args)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+
+def shutdown_hash_pool() -> None:
+    """Stop the hashing process pool, if it was started."""
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False, cancel_futures=True)
+        _hash_pool = None
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password, reusing the result of an identical recent attempt.
+
+    Keys are a keyed BLAKE2b digest of (stored hash, password), so a password
+    change makes old entries unreachable. Trade-off: a repeated attempt is
+    answered faster than a new one, which reveals it was seen in the last
+    minute; acceptable here since the result itself is unchanged.
+    """
+    key = hashlib.blake2b(
+        hashed_password.encode('utf-8') + b"\0" + plain_password.encode('utf-8'),
+        digest_size=16,
+        key=_VERIFY_CACHE_KEY
+    ).digest()
+    cached = _verify_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = await run_password_hash(verify_password, plain_password, hashed_password)
+    _verify_cache[key] = result
+    return result
+
+
+def _fetch_google_certs() -> dict:
+    """Download Google's signing certs and cache them per Cache-Control (blocking)."""
+    global _google_certs
+    response = _google_request(GOOGLE_CERTS_URL, method="GET")
+    if response.status != 200:
+        raise ValueError(f"Could not fetch Google certificates: {response.status}")
+    certs = orjson.loads(response.data)
+    max_age = _MAX_AGE_RE.search(response.headers.get("cache-control", ""))
+    ttl = int(max_age.group(1)) if max_age else GOOGLE_CERTS_DEFAULT_TTL
+    _google_certs = (certs, time.monotonic() + ttl)
+    return certs
+
+
+def _token_key_id(credential: str) -> Optional[str]:
+    """The unverified ``kid`` from an ID token's header, if it can be read."""
+    header = credential.split(".", 1)[0]
     try:
-        return bcrypt.checkpw(
-            plain_password.encode('utf-8'),
-            hashed_password.encode('utf-8')
-        )
-    except Exception as e:
-        logger.error(f"Password verification error: {e}")
-        return False
+        return orjson.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))).get("kid")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _verify_google_credential(credential: str) -> dict:
+    """Verify a Google ID token against Google's signing certs (blocking).
 
+    Equivalent to id_token.verify_oauth2_token, but reuses one HTTP session
+    and caches the certs instead of fetching them on every call. A token
+    signed with a key the cached certs don't have triggers one refetch, so
+    key rotation doesn't wait for the cache to expire.
+    """
+    global _google_request
+    import requests
+    from google.auth import jwt as google_jwt
+    from google.auth.transport import requests as google_requests
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    if _google_request is None:
+        _google_request = google_requests.Request(session=requests.Session())
+
+    cached = _google_certs
+    if cached is None or time.monotonic() >= cached[1]:
+        certs = _fetch_google_certs()
+    else:
+        certs = cached[0]
+        key_id = _token_key_id(credential)
+        if key_id is not None and key_id not in certs:
+            certs = _fetch_google_certs()
+
+    # Verify the Google token with clock skew tolerance
+    idinfo = google_jwt.decode(
+        credential,
+        certs=certs,
+        audience=settings.GOOGLE_CLIENT_ID,
+        clock_skew_in_seconds=30  # Allow 30 seconds clock skew
+    )
+    if idinfo.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+    return idinfo
 
 
 @router.post("/login", response_model=TokenResponse)
-async def login(request: LoginRequest, db: Session = Depends(get_db)):
+async def login(request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """Login with email/password or register new user."""
     logger.info(f"Login attempt for email: {request.email}")
     
     try:
-        user = db.query(User).filter(User.email == request.email).first()
+        email = validate_email(request.email)
+        user = await get_user_by_email(db, email)
         
         if user:
             # Existing user - verify password
             if request.password:
-                if user.password_hash and verify_password(request.password, user.password_hash):
-                    logger.info(f"Password login successful for: {request.email}")
+                if user.password_hash and await check_password(request.password, user.password_hash):
+                    logger.info(f"Password login successful for: {email}")
                 elif not user.password_hash:
                     # User exists but no password set (e.g., Google auth user)
                     # Set password for first time
-                    user.password_hash = hash_password(request.password)
-                    db.commit()
-                    logger.info(f"Password set for existing user: {request.email}")
+                    user.password_hash = await run_password_hash(hash_password, request.password)
+                    await db.commit()
+                    invalidate_user_cache(email, user.id)
+                    logger.info(f"Password set for existing user: {email}")
                 else:
-                    logger.warning(f"Invalid password for: {request.email}")
+                    logger.warning(f"Invalid password for: {email}")
                     raise HTTPException(
                         status_code=status.HTTP_401_UNAUTHORIZED,
                         detail="Invalid email or password"
@@ -103,14 +265,14 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
                 )
             
             user = User(
-                email=request.email,
-                name=request.name or request.email.split("@")[0],
-                password_hash=hash_password(request.password)
+                email=email,
+                name=request.name or email.partition("@")[0],
+                password_hash=await run_password_hash(hash_password, request.password)
             )
             db.add(user)
-            db.commit()
-            db.refresh(user)
-            logger.info(f"New user registered: {request.email}")
+            await db.commit()
+            invalidate_user_cache(email)
+            logger.info(f"New user registered: {email}")
         
         # Generate token
         access_token = create_access_token(
@@ -138,11 +300,11 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
 
 
 @router.post("/google", response_model=TokenResponse)
-async def google_auth(request: GoogleAuthRequest, db: Session = Depends(get_db)):
+async def google_auth(request: GoogleAuthRequest, db: AsyncSession = Depends(get_async_db)):
     """Authenticate with Google OAuth."""
     logger.info("Google auth attempt")
     
-    if not GOOGLE_CLIENT_ID:
+    if not settings.GOOGLE_CLIENT_ID:
         logger.error("GOOGLE_CLIENT_ID not configured")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -150,16 +312,8 @@ async def google_auth(request: GoogleAuthRequest, db: Session = Depends(get_db))
         )
     
     try:
-        from google.oauth2 import id_token
-        from google.auth.transport import requests
-        
-        # Verify the Google token with clock skew tolerance
-        idinfo = id_token.verify_oauth2_token(
-            request.credential,
-            requests.Request(),
-            GOOGLE_CLIENT_ID,
-            clock_skew_in_seconds=30  # Allow 30 seconds clock skew
-        )
+        # Cert fetch + RSA verify are blocking; keep them off the event loop
+        idinfo = await asyncio.to_thread(_verify_google_credential, request.credential)
         
         email = idinfo.get("email")
         name = idinfo.get("name", email.split("@")[0] if email else "User")
@@ -169,23 +323,25 @@ async def google_auth(request: GoogleAuthRequest, db: Session = Depends(get_db))
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email not provided by Google"
             )
+        email = email.lower()
         
         logger.info(f"Google auth for email: {email}")
         
         # Find or create user
-        user = db.query(User).filter(User.email == email).first()
+        user = await get_user_by_email(db, email)
         
         if not user:
             user = User(email=email, name=name)
             db.add(user)
-            db.commit()
-            db.refresh(user)
+            await db.commit()
+            invalidate_user_cache(email)
             logger.info(f"New user created via Google: {email}")
         else:
             # Update name if changed
             if name and user.name != name:
                 user.name = name
-                db.commit()
+                await db.commit()
+                invalidate_user_cache(email, user.id)
         
         # Generate token
         access_token = create_access_token(
@@ -217,21 +373,21 @@ async def google_auth(request: GoogleAuthRequest, db: Session = Depends(get_db))
 
 
 @router.get("/me")
-async def get_me(db: Session = Depends(get_db), token: str = None):
+async def get_me(db: AsyncSession = Depends(get_async_db), token: str = None):
     """Get current user from token."""
     # This would need token from header - simplified for now
     return {"message": "Use Authorization header with Bearer token"}
 
 
 @router.post("/register", response_model=TokenResponse)
-async def register(request: LoginRequest, db: Session = Depends(get_db)):
+async def register(request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """Register a new user with email/password."""
     logger.info(f"Registration attempt for email: {request.email}")
     
     try:
+        email = validate_email(request.email)
         # Check if user already exists
-        existing_user = db.query(User).filter(User.email == request.email).first()
-        if existing_user:
+        if await user_exists(db, email):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email already registered"
@@ -251,14 +407,14 @@ async def register(request: LoginRequest, db: Session = Depends(get_db)):
         
         # Create new user
         user = User(
-            email=request.email,
-            name=request.name or request.email.split("@")[0],
-            password_hash=hash_password(request.password)
+            email=email,
+            name=request.name or email.partition("@")[0],
+            password_hash=await run_password_hash(hash_password, request.password)
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
-        logger.info(f"New user registered: {request.email}")
+        await db.commit()
+        invalidate_user_cache(email)
+        logger.info(f"New user registered: {email}")
         
         # Generate token
         access_token = create_access_token(
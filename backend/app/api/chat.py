@@ -1,16 +1,80 @@
 from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from app.database import get_db
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import bindparam, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, raiseload
+from app.database import attach_cached, get_async_db, row_values
 from app.models.schemas import ChatSession, Message, User, Course
-from app.core.security import get_current_user
+from app.core.security import get_current_user_async
 from pydantic import BaseModel
 from typing import Optional
+from app.services.gemini_service import RateLimitError
 from app.services.rag_service import rag_service
-import json
+import orjson
+import os
+import time
+from cachetools import TTLCache
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 
+# Streamed model chunks are coalesced into one SSE event until this many
+# characters are buffered, or STREAM_FLUSH_INTERVAL seconds have passed
+# since the last event (so a slow stream still shows progress)
+STREAM_FLUSH_SIZE = int(os.getenv("STREAM_FLUSH_SIZE", "256"))
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.05"))
+
+# Upper bound on messages returned for one session
+MAX_SESSION_MESSAGES = 1000
+
+# Statements built once so their compiled SQL is reused from the engine's cache
+_STMT_SESSION_BY_ID_USER = select(ChatSession).where(
+    ChatSession.id == bindparam("session_id"),
+    ChatSession.user_id == bindparam("user_id")
+)
+# Only the course is read from a loaded session; other relationships raise
+_STMT_SESSION_WITH_COURSE = _STMT_SESSION_BY_ID_USER.options(
+    joinedload(ChatSession.course), raiseload("*")
+)
+# Newest MAX_SESSION_MESSAGES messages, reversed into chronological order by the caller
+_STMT_MESSAGES_BY_SESSION = select(
+    Message.id,
+    Message.session_id,
+    Message.role,
+    Message.content,
+    Message.msg_metadata,
+    Message.timestamp
+).where(
+    Message.session_id == bindparam("session_id")
+).order_by(Message.timestamp.desc()).limit(MAX_SESSION_MESSAGES)
+
+# Course column values for new sessions, so starting a chat doesn't re-read the course;
+# keyed by (owner id, course id), and courses.delete_course drops entries via
+# invalidate_course_cache
+_course_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
+
+# SSE framing; events are emitted as bytes so StreamingResponse sends them as-is
+_SSE_DATA = b"data: "
+_SSE_END = b"\n\n"
+
+async def get_course_cached(db: AsyncSession, course_id: int, user_id: int) -> Optional[Course]:
+    """Load a course of ``user_id`` for a new chat session, serving repeats
+    from the TTL cache; None if it doesn't exist or belongs to someone else."""
+    cached = _course_cache.get((user_id, course_id))
+    if cached is not None:
+        return attach_cached(db, Course, cached)
+
+    course = await db.get(Course, course_id)
+    if course is None or course.user_id != user_id:
+        return None
+    _course_cache[(user_id, course_id)] = row_values(course)
+    return course
+
+
+def invalidate_course_cache(course_id: int, user_id: int) -> None:
+    """Drop a cached course after it is modified or deleted."""
+    _course_cache.pop((user_id, course_id), None)
+
+
 class ChatRequest(BaseModel):
     message: str
     session_id: Optional[int] = None
@@ -24,14 +88,17 @@ class SessionCreate(BaseModel):
 @router.post("/session")
 async def create_session(
     request: SessionCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create a new chat session"""
-    course = db.query(Course).filter(
-        Course.id == request.course_id,
-        Course.user_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(Course).where(
+            Course.id == request.course_id,
+            Course.user_id == current_user.id
+        )
+    )
+    course = result.scalar_one_or_none()
     
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
@@ -43,36 +110,37 @@ async def create_session(
         context={}
     )
     db.add(session)
-    db.commit()
-    db.refresh(session)
+    await db.commit()
     
     return {"session_id": session.id}
 
 @router.post("/message")
 async def send_message(
     request: ChatRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Send a message and get response (non-streaming)"""
-    from app.services.gemini_service import RateLimitError
-    
     # Get or create session
     if request.session_id:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == request.session_id,
-            ChatSession.user_id == current_user.id
-        ).first()
+        result = await db.execute(
+            _STMT_SESSION_WITH_COURSE,
+            {"session_id": request.session_id, "user_id": current_user.id}
+        )
+        session = result.scalar_one_or_none()
     else:
+        course = await get_course_cached(db, request.course_id, current_user.id)
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
         session = ChatSession(
             user_id=current_user.id,
-            course_id=request.course_id,
+            course=course,
             teaching_mode="qa",
             context={}
         )
         db.add(session)
-        db.commit()
-        db.refresh(session)
+        # Flush only to get session.id; everything commits together below
+        await db.flush()
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -84,13 +152,12 @@ async def send_message(
     session_context = session.context or {}
     session_context["current_unit_id"] = request.current_unit_id
     
-    # Save user message
+    # Build user message; it is written with the assistant reply in one commit
     user_message = Message(
         session_id=session.id,
         role="user",
         content=request.message
     )
-    db.add(user_message)
     
     try:
         # Retrieve context
@@ -100,15 +167,12 @@ async def send_message(
             session_context=session_context
         )
         
-        # Get course info
-        course = db.query(Course).filter(Course.id == request.course_id).first()
-        
         # Generate response
         response_text = await rag_service.generate_response(
             query=request.message,
             retrieved_chunks=chunks,
             session_context=session_context,
-            course_name=course.name
+            course_name=session.course.name
         )
     except RateLimitError as e:
         # Return a friendly error message
@@ -118,16 +182,17 @@ async def send_message(
         response_text = f"⚠️ **Error**\n\nSorry, there was an error generating a response. Please try again.\n\nError details: {str(e)[:100]}"
         chunks = []
     
-    # Save assistant message
+    # Save both messages and the session update in a single transaction;
+    # the question is kept so a follow-up can be searched alongside it
+    session.context = {**session_context, "previous_query": request.message}
     assistant_message = Message(
         session_id=session.id,
         role="assistant",
         content=response_text,
-        metadata={"chunks_used": len(chunks)}
+        msg_metadata={"chunks_used": len(chunks)}
     )
-    db.add(assistant_message)
-    
-    db.commit()
+    db.add_all([user_message, assistant_message])
+    await db.commit()
     
     return {
         "response": response_text,
@@ -138,27 +203,30 @@ async def send_message(
 @router.post("/message/stream")
 async def send_message_stream(
     request: ChatRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Send a message and get streaming response"""
     
     # Get or create session
     if request.session_id:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == request.session_id,
-            ChatSession.user_id == current_user.id
-        ).first()
+        result = await db.execute(
+            _STMT_SESSION_WITH_COURSE,
+            {"session_id": request.session_id, "user_id": current_user.id}
+        )
+        session = result.scalar_one_or_none()
     else:
+        course = await get_course_cached(db, request.course_id, current_user.id)
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
         session = ChatSession(
             user_id=current_user.id,
-            course_id=request.course_id,
+            course=course,
             teaching_mode="qa",
             context={}
         )
-        db.add(session)
-        db.commit()
-        db.refresh(session)
+        # Not flushed: a new session is inserted with its first messages
+        # when the stream finishes
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -168,14 +236,11 @@ async def send_message_stream(
     if request.current_unit_id:
         session_context["current_unit_id"] = request.current_unit_id
     
-    # Save user message
+    # Buffer user message; saved together with the full response
     user_message = Message(
-        session_id=session.id,
         role="user",
         content=request.message
     )
-    db.add(user_message)
-    db.commit()
     
     # Retrieve context
     chunks = await rag_service.retrieve_context(
@@ -184,65 +249,101 @@ async def send_message_stream(
         session_context=session_context
     )
     
-    course = db.query(Course).filter(Course.id == request.course_id).first()
+    # Course is loaded with the session; read it before the request session closes
+    course_name = session.course.name
     
     # Stream response
     async def generate():
-        full_response = ""
+        parts = []
+        # Coalesce small model chunks into fewer, larger SSE events
+        buf = []
+        buf_len = 0
+        last_flush = time.monotonic()
         async for chunk in rag_service.generate_streaming_response(
             query=request.message,
             retrieved_chunks=chunks,
             session_context=session_context,
-            course_name=course.name
+            course_name=course_name
         ):
-            full_response += chunk
-            yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+            parts.append(chunk)
+            buf.append(chunk)
+            buf_len += len(chunk)
+            now = time.monotonic()
+            if buf_len >= STREAM_FLUSH_SIZE or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                yield _SSE_DATA + orjson.dumps({"chunk": "".join(buf)}) + _SSE_END
+                buf = []
+                buf_len = 0
+                last_flush = now
+        
+        if buf:
+            yield _SSE_DATA + orjson.dumps({"chunk": "".join(buf)}) + _SSE_END
+        full_response = "".join(parts)
         
-        # Save complete response
+        # Save user message and complete response in one commit; a new
+        # session is inserted (flushed for its id) in the same transaction
+        session.context = {**session_context, "previous_query": request.message}
+        db.add(session)
+        await db.flush()
+        user_message.session_id = session.id
         assistant_message = Message(
             session_id=session.id,
             role="assistant",
             content=full_response
         )
-        db.add(assistant_message)
-        db.commit()
+        db.add_all([user_message, assistant_message])
+        await db.commit()
         
-        yield f"data: {json.dumps({'done': True, 'session_id': session.id})}\n\n"
+        yield _SSE_DATA + orjson.dumps({"done": True, "session_id": session.id}) + _SSE_END
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"X-Accel-Buffering": "no"}  # Stop nginx from buffering the stream
+    )
 
 @router.get("/sessions")
 async def get_sessions(
     course_id: Optional[int] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all sessions for user"""
-    query = db.query(ChatSession).filter(ChatSession.user_id == current_user.id)
+    # Read-only listing: project plain columns instead of hydrating ORM rows
+    query = select(
+        ChatSession.id,
+        ChatSession.user_id,
+        ChatSession.course_id,
+        ChatSession.current_unit_id,
+        ChatSession.teaching_mode,
+        ChatSession.created_at
+    ).where(ChatSession.user_id == current_user.id)
     
     if course_id:
-        query = query.filter(ChatSession.course_id == course_id)
+        query = query.where(ChatSession.course_id == course_id)
     
-    sessions = query.all()
-    return sessions
+    result = await db.execute(query.order_by(ChatSession.id))
+    rows = result.all()
+    return ORJSONResponse([dict(row._mapping) for row in rows])
 
 @router.get("/sessions/{session_id}/messages")
 async def get_session_messages(
     session_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all messages in a session"""
-    session = db.query(ChatSession).filter(
-        ChatSession.id == session_id,
-        ChatSession.user_id == current_user.id
-    ).first()
+    result = await db.execute(
+        _STMT_SESSION_BY_ID_USER,
+        {"session_id": session_id, "user_id": current_user.id}
+    )
+    session = result.scalar_one_or_none()
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    messages = db.query(Message).filter(
-        Message.session_id == session_id
-    ).order_by(Message.timestamp).all()
+    result = await db.execute(
+        _STMT_MESSAGES_BY_SESSION, {"session_id": session_id}
+    )
+    rows = result.all()
     
-    return messages
+    return ORJSONResponse([dict(row._mapping) for row in reversed(rows)])
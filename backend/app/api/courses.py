@@ -1,19 +1,67 @@
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile, File, Form
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models.schemas import Course, Unit, User, UploadedFile, ChatSession, Message
+from sqlalchemy import bindparam, delete, exists, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, raiseload
+from app.database import SessionLocal, get_db, has_index
+from app.models.schemas import Course, Document, Unit, User, UploadedFile, ChatSession, Message
+from app.core.config import settings
 from app.core.security import get_current_user
+from app.api.chat import invalidate_course_cache
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+from collections import defaultdict
 from datetime import datetime
-import hashlib
+import asyncio
+import os
+from blake3 import blake3
 from app.services.document_processor import document_processor
-from app.services.vector_store import vector_store
+from app.services.vector_store import _run_blocking, vector_store
+from app.services.task_queue import enqueue_job
+from app.utils.compression import compress_text, decompress_text
 from app.utils.logging_config import get_logger
 
 logger = get_logger("courses")
 router = APIRouter(prefix="/api/courses", tags=["courses"])
 
+# Uploads are hashed in reads of this size
+UPLOAD_READ_CHUNK = 64 * 1024
+MAX_FILE_SIZE = 15 * 1024 * 1024
+MAX_FILES = 10
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.docx', '.pptx'})
+# Declared types accepted for those extensions; generic types are allowed
+# because some clients send them for Office files
+ALLOWED_CONTENT_TYPES = frozenset({
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/octet-stream',
+    'application/zip',
+})
+
+# Dialects whose insert() supports ON CONFLICT
+_UPSERT_INSERT = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+# Earlier copies of a file (by BLAKE3 of its bytes), in any course
+_STMT_EXTRACTED_BY_HASH = select(UploadedFile.extracted_text_zst).where(
+    UploadedFile.content_hash == bindparam("content_hash"),
+    UploadedFile.extracted_text_zst.is_not(None)
+).limit(1)
+
+async def get_owned_course(
+    course_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+) -> Course:
+    """Dependency: the path's course, 404 unless it belongs to the current user."""
+    # Handlers only read course columns; a relationship access raises
+    # instead of quietly issuing extra SELECTs
+    course = db.get(Course, course_id, options=[raiseload("*")])
+    if not course or course.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Course not found")
+    return course
+
 class CourseCreate(BaseModel):
     name: str
     description: str = ""
@@ -47,7 +95,6 @@ async def create_course(
     )
     db.add(new_course)
     db.commit()
-    db.refresh(new_course)
     
     return new_course
 
@@ -57,42 +104,26 @@ async def get_courses(
     db: Session = Depends(get_db)
 ):
     """Get all courses for current user"""
-    courses = db.query(Course).filter(Course.user_id == current_user.id).all()
+    # CourseResponse renders no relationships; raiseload makes any future
+    # lazy load during serialization fail loudly instead of going N+1
+    courses = db.query(Course).options(raiseload("*")).filter(Course.user_id == current_user.id).all()
     return courses
 
 @router.get("/{course_id}", response_model=CourseResponse)
 async def get_course(
-    course_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    course: Course = Depends(get_owned_course)
 ):
     """Get a specific course by ID"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-    
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
     return course
 
 @router.post("/{course_id}/units")
 async def create_unit(
     course_id: int,
     unit: UnitCreate,
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Create a unit in a course"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-    
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
     new_unit = Unit(
         course_id=course_id,
         parent_unit_id=unit.parent_unit_id,
@@ -102,101 +133,140 @@ async def create_unit(
     )
     db.add(new_unit)
     db.commit()
-    db.refresh(new_unit)
     
     return new_unit
 
-@router.post("/{course_id}/upload")
+@router.post("/{course_id}/upload", status_code=202)
 async def upload_documents(
     course_id: int,
     background_tasks: BackgroundTasks,
     files: list[UploadFile] = File(...),
     unit_id: Optional[int] = Form(None),
     topic_name: Optional[str] = Form(None),
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Upload documents quickly; process text in background."""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-
-    MAX_FILE_SIZE = 15 * 1024 * 1024
-    MAX_FILES = 10
-    ALLOWED_EXTENSIONS = {'.pdf', '.docx', '.pptx'}
-
     if len(files) > MAX_FILES:
         raise HTTPException(status_code=400, detail=f"Maximum {MAX_FILES} files allowed")
 
     uploaded_files = []
 
-    for file in files:
-        ext = '.' + file.filename.lower().split('.')[-1]
+    # One query for every fingerprint already in the course; also dedups within this batch
+    existing_hashes = set(db.scalars(
+        select(UploadedFile.content_hash).where(UploadedFile.course_id == course_id)
+    ).all())
+
+    async def handle_one(file: UploadFile) -> Optional[dict]:
+        """Hash and extract one upload; returns its pending row or None."""
+        ext = os.path.splitext((file.filename or '').lower())[1]
         if ext not in ALLOWED_EXTENSIONS:
             logger.warning(f"Skipping unsupported file type: {file.filename}")
-            continue
+            return None
+        if file.content_type and file.content_type not in ALLOWED_CONTENT_TYPES:
+            logger.warning(f"Skipping {file.filename}: unexpected content type {file.content_type}")
+            return None
 
-        content = await file.read()
-        file_size = len(content)
-
-        if file_size > MAX_FILE_SIZE:
+        # Declared size is known from the multipart parse; reject before reading
+        if file.size is not None and file.size > MAX_FILE_SIZE:
             logger.warning(f"File {file.filename} exceeds size limit")
-            continue
-
-        try:
-            extracted_text = await document_processor.extract_text_from_bytes(content, file.filename)
-        except Exception as e:
-            logger.error(f"Failed to extract text from {file.filename}: {e}")
-            continue
-
-        text_hash = hashlib.sha256(extracted_text.encode()).hexdigest()
+            return None
+
+        async with upload_slots:
+            # Starlette has already spooled the upload (memory, then temp file);
+            # hash it in place in chunks rather than copying it again
+            hasher = blake3()
+            file_size = await _hash_upload(file, MAX_FILE_SIZE, hasher)
+            if file_size is None:
+                logger.warning(f"File {file.filename} exceeds size limit")
+                return None
+
+            # Content hash is known before extraction, so duplicates skip it
+            # entirely; claimed before the next await so concurrent copies
+            # in this batch see it
+            content_hash = hasher.hexdigest()
+            if content_hash in existing_hashes:
+                logger.info(f"Skipping duplicate document: {file.filename}")
+                return None
+            existing_hashes.add(content_hash)
+
+            # Same bytes already extracted for another course: reuse that text
+            text_blob = db.scalar(_STMT_EXTRACTED_BY_HASH, {"content_hash": content_hash})
+            if text_blob is not None:
+                text_length = len(await asyncio.to_thread(decompress_text, text_blob))
+            else:
+                try:
+                    extracted_text = await document_processor.extract_text_from_stream(file.file, file.filename)
+                except Exception as e:
+                    logger.error(f"Failed to extract text from {file.filename}: {e}")
+                    existing_hashes.discard(content_hash)
+                    return None
+                text_length = len(extracted_text)
+                text_blob = await asyncio.to_thread(compress_text, extracted_text)
+
+        text_lengths[content_hash] = text_length
+
+        return {
+            "course_id": course_id,
+            "filename": file.filename,
+            "original_filename": file.filename,
+            "file_size": file_size,
+            "extracted_text_zst": text_blob,
+            "content_hash": content_hash,
+            "processing_status": "pending",
+            "chunks_count": 0
+        }
+
+    # Files are independent until the insert: overlap their reads and
+    # extractions, bounded so one request can't occupy the whole pool
+    upload_slots = asyncio.Semaphore(settings.UPLOAD_CONCURRENCY)
+    text_lengths: Dict[str, int] = {}
+    results = await asyncio.gather(*(handle_one(file) for file in files), return_exceptions=True)
+
+    # A file failing unexpectedly only drops that file from the batch
+    pending_rows = []
+    for file, result in zip(files, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Failed to process upload {file.filename}: {result}")
+        elif result is not None:
+            pending_rows.append(result)
+
+    # One multi-row INSERT for the batch; the unique (course_id, text_hash)
+    # index still drops rows committed by a concurrent upload
+    ids_by_hash = _insert_uploaded_files(db, pending_rows) if pending_rows else {}
+
+    target_unit_id = None
+    if ids_by_hash:
+        target_unit_id = await _get_or_create_unit(db, course_id, course.name, unit_id, topic_name)
 
-        existing = db.query(UploadedFile).filter(
-            UploadedFile.course_id == course_id,
-            UploadedFile.text_hash == text_hash
-        ).first()
+    # Rows must be visible before a worker can pick up their jobs
+    db.commit()
 
-        if existing:
-            logger.info(f"Skipping duplicate document: {file.filename}")
+    for row in pending_rows:
+        file_id = ids_by_hash.get(row["content_hash"])
+        if file_id is None:
+            logger.info(f"Skipping duplicate document: {row['filename']}")
             continue
 
-        target_unit_id = await _get_or_create_unit(db, course_id, course.name, unit_id, topic_name)
-
-        uploaded_file = UploadedFile(
-            course_id=course_id,
-            filename=file.filename,
-            original_filename=file.filename,
-            file_size=file_size,
-            extracted_text=extracted_text,
-            text_hash=text_hash,
-            processing_status="pending",
-            chunks_count=0
-        )
-        db.add(uploaded_file)
-        db.flush()
+        uploaded_files.append({
+            "id": file_id,
+            "filename": row["filename"],
+            "size": row["file_size"],
+            "status": "processing",
+            "text_length": text_lengths[row["content_hash"]]
+        })
 
-        background_tasks.add_task(
-            process_document_background,
-            uploaded_file.id,
+    # One job ingests the whole upload
+    if uploaded_files:
+        await enqueue_job(
+            background_tasks,
+            process_documents_background,
+            [f["id"] for f in uploaded_files],
             course_id,
             target_unit_id,
             course.name
         )
 
-        uploaded_files.append({
-            "id": uploaded_file.id,
-            "filename": file.filename,
-            "size": file_size,
-            "status": "processing",
-            "text_length": len(extracted_text)
-        })
-
-    db.commit()
-
     return {
         "message": f"Uploaded {len(uploaded_files)} document(s), processing in background",
         "files": uploaded_files,
@@ -206,36 +276,37 @@ async def upload_documents(
 @router.get("/{course_id}/structure")
 async def get_course_structure(
     course_id: int,
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Get hierarchical structure of course units"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
+    # Get all units; only the tree's columns (skips summary text and ORM identity bookkeeping)
+    units = db.execute(
+        select(Unit.id, Unit.parent_unit_id, Unit.name, Unit.level, Unit.order)
+        .where(Unit.course_id == course_id)
+        .order_by(Unit.order)
+    ).all()
     
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
+    # Index children by parent in one pass (units stay in Unit.order within each list)
+    children_by_parent = defaultdict(list)
+    for unit in units:
+        children_by_parent[unit.parent_unit_id].append(unit)
     
-    # Get all units
-    units = db.query(Unit).filter(Unit.course_id == course_id).order_by(Unit.order).all()
-    
-    # Build tree structure
-    def build_tree(parent_id=None):
-        children = [u for u in units if u.parent_unit_id == parent_id]
-        result = []
-        for child in children:
-            result.append({
-                "id": child.id,
-                "name": child.name,
-                "level": child.level,
-                "order": child.order,
-                "children": build_tree(child.id)
-            })
-        return result
-    
-    tree = build_tree(None)
+    # Build tree structure iteratively: each stack entry is (sibling list, unit);
+    # children are pushed reversed so they pop, and append, in Unit.order
+    tree = []
+    stack = [(tree, unit) for unit in reversed(children_by_parent[None])]
+    while stack:
+        siblings, unit = stack.pop()
+        node = {
+            "id": unit.id,
+            "name": unit.name,
+            "level": unit.level,
+            "order": unit.order,
+            "children": []
+        }
+        siblings.append(node)
+        stack.extend((node["children"], child) for child in reversed(children_by_parent[unit.id]))
     
     return {
         "course_id": course_id,
@@ -247,19 +318,20 @@ async def get_course_structure(
 @router.get("/{course_id}/documents")
 async def get_course_documents(
     course_id: int,
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Get all documents uploaded to a course"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-    
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
-    files = db.query(UploadedFile).filter(UploadedFile.course_id == course_id).all()
+    # Project only listed columns so extracted text never leaves the database
+    files = db.execute(
+        select(
+            UploadedFile.id,
+            UploadedFile.original_filename,
+            UploadedFile.file_size,
+            UploadedFile.chunks_count,
+            UploadedFile.uploaded_at
+        ).where(UploadedFile.course_id == course_id)
+    )
     
     return {
         "course_id": course_id,
@@ -275,6 +347,54 @@ async def get_course_documents(
         ]
     }
 
+def _insert_uploaded_files(db: Session, rows: List[dict]) -> Dict[str, int]:
+    """Insert UploadedFile rows, returning {content_hash: id} for rows actually inserted."""
+    insert = _UPSERT_INSERT.get(db.get_bind().dialect.name)
+    if insert is not None and has_index("uq_uploaded_files_course_hash"):
+        # ORM bulk INSERT: rows are keyed by mapped attribute names
+        stmt = insert(UploadedFile).on_conflict_do_nothing(
+            index_elements=["course_id", "text_hash"]
+        ).returning(UploadedFile.id, UploadedFile.content_hash)
+        return {
+            content_hash: file_id
+            for file_id, content_hash in db.execute(stmt, rows)
+        }
+
+    # Other backends, or no unique index: skip files the course already has
+    # (committed since the upload's own check), and let the index, where
+    # present, catch the remaining races inside a savepoint per row
+    existing = set(db.scalars(
+        select(UploadedFile.content_hash).where(
+            UploadedFile.course_id == rows[0]["course_id"],
+            UploadedFile.content_hash.in_([row["content_hash"] for row in rows])
+        )
+    ))
+    inserted = {}
+    for row in rows:
+        if row["content_hash"] in existing:
+            continue
+        uploaded_file = UploadedFile(**row)
+        try:
+            with db.begin_nested():
+                db.add(uploaded_file)
+        except IntegrityError:
+            continue
+        inserted[row["content_hash"]] = uploaded_file.id
+    return inserted
+
+
+async def _hash_upload(file: UploadFile, max_size: int, hasher) -> Optional[int]:
+    """Feed an upload to hasher chunk by chunk and rewind it; None if it exceeds max_size."""
+    file_size = 0
+    while chunk := await file.read(UPLOAD_READ_CHUNK):
+        file_size += len(chunk)
+        if file_size > max_size:
+            return None
+        hasher.update(chunk)
+    await file.seek(0)
+    return file_size
+
+
 async def _get_or_create_unit(
     db: Session,
     course_id: int,
@@ -287,21 +407,40 @@ async def _get_or_create_unit(
         return unit_id
 
     if topic_name:
-        existing_unit = db.query(Unit).filter(
-            Unit.course_id == course_id,
-            Unit.name == topic_name
+        insert = _UPSERT_INSERT.get(db.get_bind().dialect.name)
+        if insert is not None and has_index("uq_units_course_topic_name"):
+            # One race-free statement: insert the topic unit or, if the
+            # course already has it, touch it so RETURNING yields its id
+            stmt = insert(Unit).values(
+                course_id=course_id,
+                name=topic_name,
+                order=_next_unit_order(course_id),
+                level=1
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["course_id", "name"],
+                index_where=Unit.level == 1,
+                set_={"name": stmt.excluded.name}
+            ).returning(Unit.id)
+            return db.scalar(stmt)
+
+        # Other backends, or no unique index to conflict on: look it up first
+        existing_unit = db.scalars(
+            select(Unit).where(
+                Unit.course_id == course_id,
+                Unit.name == topic_name,
+                Unit.level == 1
+            )
         ).first()
         if not existing_unit:
-            next_order = db.query(Unit).filter(Unit.course_id == course_id).count()
             existing_unit = Unit(
                 course_id=course_id,
                 name=topic_name,
-                order=next_order,
+                order=db.scalar(select(_next_unit_order(course_id))),
                 level=1
             )
             db.add(existing_unit)
-            db.commit()
-            db.refresh(existing_unit)
+            db.flush()
         return existing_unit.id
 
     default_unit = db.query(Unit).filter(
@@ -317,105 +456,156 @@ async def _get_or_create_unit(
             level=0
         )
         db.add(default_unit)
-        db.commit()
-        db.refresh(default_unit)
+        db.flush()
 
     return default_unit.id
 
 
-async def process_document_background(
-    file_id: int,
-    course_id: int,
-    unit_id: int,
-    course_name: str
-):
-    """Background task: chunk + embed extracted text."""
-    from app.database import SessionLocal
+def _next_unit_order(course_id: int):
+    """Scalar subquery: one past the highest unit order in the course."""
+    return select(
+        func.coalesce(func.max(Unit.order), -1) + 1
+    ).where(Unit.course_id == course_id).scalar_subquery()
 
-    db = SessionLocal()
-    try:
-        file = db.query(UploadedFile).filter(UploadedFile.id == file_id).first()
-        if not file:
-            return
 
-        file.processing_status = "processing"
-        db.commit()
+def _chunk_ids(course_id: int, file_id: int, count: int) -> List[str]:
+    """Vector store ids for a file's chunks; the format is what existing collections hold."""
+    prefix = f"course_{course_id}_file_{file_id}_chunk_"
+    return [prefix + str(i) for i in range(count)]
 
-        chunks = document_processor.create_semantic_chunks(
-            file.extracted_text or "",
-            {
-                "unit_id": unit_id,
-                "unit_name": course_name,
-                "source": file.filename,
-                "file_id": file_id
-            }
-        )
-
-        documents = [chunk["content"] for chunk in chunks]
-        metadatas = [chunk["metadata"] for chunk in chunks]
-        ids = [f"course_{course_id}_file_{file_id}_chunk_{i}" for i in range(len(chunks))]
 
-        await vector_store.add_documents_batched(
+async def process_documents_background(
+    file_ids: List[int],
+    course_id: int,
+    unit_id: int,
+    course_name: str
+):
+    """Background task: chunk + embed the extracted text of one upload's files.
+
+    Chunks of every file are pooled and sent to the vector store in batches
+    of settings.INGEST_BATCH_SIZE. Each batch is embedded and written while
+    the next files are chunked, and at most one batch is waiting at a time.
+    """
+    documents: List[str] = []
+    metadatas: List[Dict] = []
+    ids: List[str] = []
+    pending: Optional[asyncio.Task] = None
+
+    async def flush() -> None:
+        nonlocal documents, metadatas, ids, pending
+        if pending is not None:
+            await pending
+        pending = asyncio.create_task(vector_store.add_documents_batched(
             course_id=course_id,
             documents=documents,
             metadatas=metadatas,
             ids=ids
-        )
+        ))
+        documents, metadatas, ids = [], [], []
 
-        file.processing_status = "completed"
-        file.chunks_count = len(chunks)
-        db.commit()
+    with SessionLocal() as db:
+        try:
+            files = db.scalars(
+                select(UploadedFile).where(UploadedFile.id.in_(file_ids)).order_by(UploadedFile.id)
+            ).all()
+            if not files:
+                return
+
+            for file in files:
+                file.processing_status = "processing"
+            db.commit()
 
-    except Exception as e:
-        logger.error(f"Background processing failed for file {file_id}: {e}")
-        file.processing_status = "failed"
-        db.commit()
-    finally:
-        db.close()
+            for file in files:
+                chunks = await document_processor.create_semantic_chunks_async(
+                    file.text,
+                    {
+                        "unit_id": unit_id,
+                        "unit_name": course_name,
+                        "source": file.filename,
+                        "file_id": file.id
+                    }
+                )
+
+                documents.extend(chunk["content"] for chunk in chunks)
+                metadatas.extend(chunk["metadata"] for chunk in chunks)
+                ids.extend(_chunk_ids(course_id, file.id, len(chunks)))
+                file.chunks_count = len(chunks)
+
+                if len(documents) >= settings.INGEST_BATCH_SIZE:
+                    await flush()
+
+            if documents:
+                await flush()
+            if pending is not None:
+                await pending
+
+            for file in files:
+                file.processing_status = "completed"
+            db.commit()
+
+        except Exception:
+            logger.exception(f"Background processing failed for files {file_ids}")
+            if pending is not None and not pending.done():
+                pending.cancel()
+            # The session may be mid-transaction; mark failed by PK rather
+            # than through instances that might never have loaded
+            db.rollback()
+            db.execute(
+                update(UploadedFile)
+                .where(UploadedFile.id.in_(file_ids))
+                .values(processing_status="failed")
+            )
+            db.commit()
 
 
 @router.delete("/{course_id}")
 async def delete_course(
     course_id: int,
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Delete a course and all its data"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-    
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
     logger.info(f"Deleting course {course_id}: {course.name}")
     
     try:
-        # Delete from vector store
-        vector_store.delete_collection(course_id)
+        # Delete from vector store (file/index I/O, on the store's thread pool)
+        await _run_blocking(vector_store.delete_collection, course_id)
         
         # Delete uploaded files from disk
-        files = db.query(UploadedFile).filter(UploadedFile.course_id == course_id).all()
-        for f in files:
-            if f.file_path and os.path.exists(f.file_path):
-                os.remove(f.file_path)
+        # Skip paths another course's rows still reference
+        other = aliased(UploadedFile)
+        file_paths = db.scalars(
+            select(UploadedFile.file_path).distinct().where(
+                UploadedFile.course_id == course_id,
+                UploadedFile.file_path.is_not(None),
+                ~exists().where(
+                    other.file_path == UploadedFile.file_path,
+                    other.course_id != course_id
+                )
+            )
+        )
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
         
-        # Delete chat sessions and messages
-        sessions = db.query(ChatSession).filter(ChatSession.course_id == course_id).all()
-        for session in sessions:
-            db.query(Message).filter(Message.session_id == session.id).delete()
-        db.query(ChatSession).filter(ChatSession.course_id == course_id).delete()
+        # Delete chat sessions and messages; one DELETE covers every session's messages
+        course_sessions = select(ChatSession.id).where(ChatSession.course_id == course_id)
+        db.execute(delete(Message).where(Message.session_id.in_(course_sessions)))
+        db.execute(delete(ChatSession).where(ChatSession.course_id == course_id))
         
         # Delete uploaded files records
-        db.query(UploadedFile).filter(UploadedFile.course_id == course_id).delete()
+        db.execute(delete(UploadedFile).where(UploadedFile.course_id == course_id))
         
-        # Delete units
-        db.query(Unit).filter(Unit.course_id == course_id).delete()
+        # Delete units (and any unit documents referencing them)
+        course_units = select(Unit.id).where(Unit.course_id == course_id)
+        db.execute(delete(Document).where(Document.unit_id.in_(course_units)))
+        db.execute(delete(Unit).where(Unit.course_id == course_id))
         
-        # Delete course
-        db.delete(course)
+        # Delete course; a Core DELETE, since db.delete() would first load
+        # units/sessions/uploaded_files just to find them already gone
+        db.execute(delete(Course).where(Course.id == course_id))
         db.commit()
+        invalidate_course_cache(course_id, course.user_id)
         
         logger.info(f"Successfully deleted course {course_id}")
         return {"message": "Course deleted successfully"}
@@ -430,18 +620,10 @@ async def delete_course(
 async def delete_document(
     course_id: int,
     document_id: int,
-    current_user: User = Depends(get_current_user),
+    course: Course = Depends(get_owned_course),
     db: Session = Depends(get_db)
 ):
     """Delete a specific document from a course"""
-    course = db.query(Course).filter(
-        Course.id == course_id,
-        Course.user_id == current_user.id
-    ).first()
-    
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
     file = db.query(UploadedFile).filter(
         UploadedFile.id == document_id,
         UploadedFile.course_id == course_id
@@ -452,7 +634,13 @@ async def delete_document(
     
     try:
         # Delete file from disk
-        if file.file_path and os.path.exists(file.file_path):
+        # Only when no other row shares the file
+        if file.file_path and os.path.exists(file.file_path) and not db.scalar(
+            select(exists().where(
+                UploadedFile.file_path == file.file_path,
+                UploadedFile.id != file.id
+            ))
+        ):
             os.remove(file.file_path)
         
         # Delete record
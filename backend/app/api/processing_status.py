@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app.models.schemas import UploadedFile, User, Course
@@ -28,30 +29,42 @@ async def get_processing_status(
     if not course:
         return {"error": "Course not found", "files": [], "all_completed": True}
     
-    files = db.query(UploadedFile).filter(
-        UploadedFile.course_id == course_id
-    ).order_by(UploadedFile.uploaded_at.desc()).all()
+    # Polled often: project the status columns instead of loading extracted_text
+    files = db.execute(
+        select(
+            UploadedFile.id,
+            UploadedFile.filename,
+            UploadedFile.processing_status,
+            UploadedFile.chunks_count,
+            UploadedFile.uploaded_at
+        ).where(
+            UploadedFile.course_id == course_id
+        ).order_by(UploadedFile.uploaded_at.desc())
+    ).all()
+    
+    # One pass builds the list and both summary figures
+    file_list = []
+    completed_count = 0
+    pending_count = 0
+    for f in files:
+        file_status = f.processing_status or "completed"
+        if file_status == "completed":
+            completed_count += 1
+        elif file_status in ("pending", "processing"):
+            pending_count += 1
+        file_list.append({
+            "id": f.id,
+            "filename": f.filename,
+            "status": file_status,
+            "chunks_count": f.chunks_count or 0,
+            "uploaded_at": f.uploaded_at.isoformat() if f.uploaded_at else None
+        })
     
     return {
         "course_id": course_id,
-        "files": [
-            {
-                "id": f.id,
-                "filename": f.filename,
-                "status": f.processing_status or "completed",
-                "chunks_count": f.chunks_count or 0,
-                "uploaded_at": f.uploaded_at.isoformat() if f.uploaded_at else None
-            }
-            for f in files
-        ],
-        "all_completed": all(
-            (f.processing_status or "completed") == "completed" 
-            for f in files
-        ),
-        "pending_count": sum(
-            1 for f in files 
-            if (f.processing_status or "completed") in ["pending", "processing"]
-        )
+        "files": file_list,
+        "all_completed": completed_count == len(file_list),
+        "pending_count": pending_count
     }
 
 
@@ -77,5 +90,5 @@ async def get_file_status(
         "status": file.processing_status or "completed",
         "chunks_count": file.chunks_count or 0,
         "file_size": file.file_size,
-        "text_length": len(file.extracted_text) if file.extracted_text else 0
+        "text_length": len(file.text)
     }
@@ -1,6 +1,7 @@
 """Application configuration - Production ready settings"""
+from functools import cached_property, lru_cache
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Tuple
 import os
 
 
@@ -21,6 +22,7 @@ class Settings(BaseSettings):
     SECRET_KEY: str = os.environ.get("SECRET_KEY", "change-this-in-production")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 10080  # 7 days
+    BCRYPT_ROUNDS: int = int(os.environ.get("BCRYPT_ROUNDS", "12"))  # bcrypt cost factor
     
     # Google OAuth
     GOOGLE_CLIENT_ID: str = os.environ.get("GOOGLE_CLIENT_ID", "")
@@ -32,8 +34,26 @@ class Settings(BaseSettings):
     # Storage
     UPLOAD_DIR: str = "./uploads"
     CHROMA_DIR: str = "./storage/chroma_db"
+    # Chroma server to use instead of the embedded store in CHROMA_DIR
+    CHROMA_HOST: str = os.environ.get("CHROMA_HOST", "")
+    CHROMA_PORT: int = int(os.environ.get("CHROMA_PORT", "8000"))
+    # Vector store: "chroma" (HNSW) or "faiss" (exact search, for smaller courses)
+    VECTOR_BACKEND: str = os.environ.get("VECTOR_BACKEND", "chroma")
+    FAISS_DIR: str = os.environ.get("FAISS_DIR", "./storage/faiss")
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
     MAX_FILES_PER_UPLOAD: int = 10
+    # Files of one upload spooled/extracted concurrently
+    UPLOAD_CONCURRENCY: int = int(os.environ.get("UPLOAD_CONCURRENCY", str(min(10, os.cpu_count() or 1))))
+    
+    # Chunks written to the vector store per add call (embeddings are still
+    # requested in API-sized batches within each write)
+    INGEST_BATCH_SIZE: int = int(os.environ.get("INGEST_BATCH_SIZE", "500"))
+    
+    # Task queue - document processing runs in the arq worker when set and
+    # the vector store can be shared between processes (FAISS or a Chroma
+    # server), otherwise in-process as a FastAPI background task
+    REDIS_URL: str = os.environ.get("REDIS_URL", "")
+    WORKER_MAX_JOBS: int = int(os.environ.get("WORKER_MAX_JOBS", str(os.cpu_count() or 1)))
     
     # Rate limiting
     RATE_LIMIT_PER_MINUTE: int = 60
@@ -44,9 +64,10 @@ class Settings(BaseSettings):
         "http://localhost:5173,http://localhost:3000"
     )
     
-    @property
-    def CORS_ORIGINS(self) -> List[str]:
-        return [origin.strip() for origin in self.CORS_ORIGINS_STR.split(",") if origin.strip()]
+    @cached_property
+    def CORS_ORIGINS(self) -> Tuple[str, ...]:
+        # Parsed once per Settings instance rather than on every access
+        return tuple(origin.strip() for origin in self.CORS_ORIGINS_STR.split(",") if origin.strip())
     
     class Config:
         env_file = ".env"
@@ -54,4 +75,10 @@ class Settings(BaseSettings):
         extra = "allow"
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """The process-wide Settings; env and .env are parsed on first call only."""
+    return Settings()
+
+
+settings = get_settings()
@@ -1,22 +1,51 @@
 """Security utilities - JWT tokens and password hashing"""
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
+import base64
+import hashlib
+import hmac
+import time
 import bcrypt
+import orjson
+from cachetools import TTLCache
 from jose import JWTError, jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.core.config import settings
-from app.database import get_db
+from app.database import attach_cached, get_async_db, get_db, row_values
 from app.models.schemas import User
 
 security = HTTPBearer()
 
+LEGACY_TOKEN_PREFIX = b"user_"
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+# Tokens are always HS256 with the same key, so the encoded header and key
+# bytes are built once instead of per token
+_JWT_HEADER_B64 = _b64url(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+_JWT_KEY = settings.SECRET_KEY.encode("utf-8")
+
+# User column values by id across requests, so frequent pollers skip the lookup;
+# auth drops entries via invalidate_cached_user when a user changes.
+# Per-process only, like the other TTL caches.
+_user_by_id: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+
+def invalidate_cached_user(user_id: int) -> None:
+    """Drop a cached user after it is modified."""
+    _user_by_id.pop(user_id, None)
+
 
 def hash_password(password: str) -> str:
     """Hash password using bcrypt"""
     password_bytes = password.encode('utf-8')[:72]  # bcrypt limit
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
     return bcrypt.hashpw(password_bytes, salt).decode('utf-8')
 
 
@@ -30,11 +59,12 @@ def verify_password(password: str, hashed: str) -> bool:
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
-    """Create JWT access token"""
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    """Create JWT access token (HS256, signed directly with the cached key)"""
+    ttl = expires_delta.total_seconds() if expires_delta else settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    payload = {**data, "exp": int(time.time() + ttl)}
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(payload))
+    signature = hmac.new(_JWT_KEY, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + _b64url(signature)).decode("ascii")
 
 
 def decode_token(token: str) -> dict:
@@ -50,6 +80,28 @@ def decode_token(token: str) -> dict:
         )
 
 
+def _user_id_from_token(token: str) -> int:
+    """Resolve the user id carried by a bearer token."""
+    # Support both legacy tokens and JWT; unsigned legacy tokens are
+    # never accepted in production
+    if (
+        settings.ENVIRONMENT != "production"
+        and hmac.compare_digest(token[:len(LEGACY_TOKEN_PREFIX)].encode(), LEGACY_TOKEN_PREFIX)
+    ):
+        # Legacy token format: user_{id}_{random}
+        parts = token.split("_")
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise HTTPException(status_code=401, detail="Invalid token format")
+        return int(parts[1])
+
+    # JWT token
+    payload = decode_token(token)
+    user_id = payload.get("sub")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token payload")
+    return int(user_id)
+
+
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
@@ -57,24 +109,32 @@ async def get_current_user(
     """Get current user from JWT token"""
     token = credentials.credentials
     
-    # Support both legacy tokens and JWT
-    if token.startswith("user_"):
-        # Legacy token format: user_{id}_{random}
-        try:
-            parts = token.split("_")
-            user_id = int(parts[1])
-        except (IndexError, ValueError):
-            raise HTTPException(status_code=401, detail="Invalid token format")
+    user_id = _user_id_from_token(token)
+    cached = _user_by_id.get(user_id)
+    if cached is not None:
+        user = attach_cached(db, User, cached)
     else:
-        # JWT token
-        payload = decode_token(token)
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token payload")
-        user_id = int(user_id)
-    
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+        user = db.get(User, user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        _user_by_id[user_id] = row_values(user)
+    return user
+
+
+async def get_current_user_async(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_async_db)
+) -> User:
+    """Get current user from JWT token using the asyncio DB session"""
+    token = credentials.credentials
     
+    user_id = _user_id_from_token(token)
+    cached = _user_by_id.get(user_id)
+    if cached is not None:
+        user = attach_cached(db, User, cached)
+    else:
+        user = await db.get(User, user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        _user_by_id[user_id] = row_values(user)
     return user
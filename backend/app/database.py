@@ -1,6 +1,10 @@
 from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import make_transient_to_detached, sessionmaker
+from sqlalchemy.orm.util import identity_key
 from app.models.schemas import Base
+from typing import Optional
 import os
 
 # Get DATABASE_URL from environment (Render sets this directly)
@@ -11,24 +15,76 @@ DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./education.db")
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Pool sizing per engine; uploads hold a connection through extraction, so
+# size these to the expected concurrent requests (DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections per engine per worker process)
+POOL_OPTIONS = dict(
+    pool_pre_ping=True,  # Helps with connection reliability
+    pool_recycle=300,    # Recycle connections every 5 minutes
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+)
+# SQLite (local development) uses SQLAlchemy's default pools, which take no sizing
+ENGINE_POOL_OPTIONS = {} if DATABASE_URL.startswith("sqlite") else POOL_OPTIONS
+
 engine = create_engine(
     DATABASE_URL, 
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {
         "connect_timeout": 10,
         "options": "-c statement_timeout=30000"
     },
-    pool_pre_ping=True,  # Helps with connection reliability
-    pool_recycle=300,    # Recycle connections every 5 minutes
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
+    # Multi-row INSERTs send up to this many rows per statement
+    insertmanyvalues_page_size=1000,
+    # psycopg2: also batch executemany UPDATE/DELETE with execute_batch
+    **({"executemany_mode": "values_plus_batch"} if DATABASE_URL.startswith("postgresql") else {}),
+    **ENGINE_POOL_OPTIONS,
+)
+
+# expire_on_commit=False keeps ids/defaults populated at flush, so callers don't
+# need a db.refresh() round-trip after commit
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+def _async_database_url(url: str) -> str:
+    """Map the sync DATABASE_URL onto its asyncio driver."""
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+# Asyncio engine for routers that await their queries (auth, chat); the sync
+# engine above still serves the remaining routers and background tasks
+async_engine = create_async_engine(
+    _async_database_url(DATABASE_URL),
+    connect_args={} if "sqlite" in DATABASE_URL else {
+        "timeout": 10,
+        "server_settings": {"statement_timeout": "30000"}
+    },
+    insertmanyvalues_page_size=1000,
+    **ENGINE_POOL_OPTIONS,
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False as above; lazy refreshes are not possible on an AsyncSession anyway
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Schema setup at startup (create_all + additive column/index checks); there
+# are no migrations, so this is also how production schemas are upgraded.
+# Set AUTO_MIGRATE=false once a deploy's schema is known to be current.
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "true").lower() != "false"
 
 def init_db():
+    if not AUTO_MIGRATE:
+        return
     Base.metadata.create_all(bind=engine)
-    _ensure_user_password_column()
+    # One inspector for every check; it caches what it reflects
+    inspector = inspect(engine)
+    _ensure_user_password_column(inspector)
+    _ensure_uploaded_file_text_blob_column(inspector)
+    _ensure_jsonb_columns(inspector)
+    _ensure_indexes(inspector)
 
 def get_db():
     db = SessionLocal()
@@ -37,11 +93,36 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def row_values(instance) -> dict:
+    """Column values of a loaded ORM instance, for caching across requests.
 
-def _ensure_user_password_column():
+    Caches hold these plain values rather than the instance itself, which
+    belongs to the session that loaded it.
+    """
+    return {attr.key: getattr(instance, attr.key) for attr in inspect(instance).mapper.column_attrs}
+
+
+def attach_cached(db, model, values: dict):
+    """A persistent ``model`` instance in ``db`` built from cached row_values,
+    without a query; the session's own copy is returned if it already has one."""
+    session = getattr(db, "sync_session", db)  # AsyncSession or Session
+    existing = session.identity_map.get(identity_key(model, values["id"]))
+    if existing is not None:
+        return existing
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    session.add(instance)
+    return instance
+
+
+def _ensure_user_password_column(inspector):
     """Add password_hash to users table if missing (for existing DBs)."""
     try:
-        inspector = inspect(engine)
         if "users" not in inspector.get_table_names():
             return
         columns = [col["name"] for col in inspector.get_columns("users")]
@@ -53,3 +134,101 @@ def _ensure_user_password_column():
             conn.commit()
     except Exception as e:
         print(f"Warning: Could not ensure password column: {e}")
+
+
+def _ensure_uploaded_file_text_blob_column(inspector):
+    """Add extracted_text_zst to uploaded_files if missing (for existing DBs)."""
+    try:
+        if "uploaded_files" not in inspector.get_table_names():
+            return
+        columns = [col["name"] for col in inspector.get_columns("uploaded_files")]
+        if "extracted_text_zst" in columns:
+            return
+
+        column_type = "BYTEA" if engine.dialect.name == "postgresql" else "BLOB"
+        with engine.connect() as conn:
+            conn.execute(text(f"ALTER TABLE uploaded_files ADD COLUMN extracted_text_zst {column_type}"))
+            conn.commit()
+    except Exception as e:
+        print(f"Warning: Could not ensure extracted_text_zst column: {e}")
+
+
+def _ensure_jsonb_columns(inspector):
+    """Convert JSON columns created before the JSONB switch (PostgreSQL only)."""
+    if engine.dialect.name != "postgresql":
+        return
+    for table in Base.metadata.sorted_tables:
+        try:
+            if table.name not in inspector.get_table_names():
+                continue
+            current = {col["name"]: col["type"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in current or isinstance(current[column.name], JSONB):
+                    continue
+                if not isinstance(column.type.dialect_impl(engine.dialect), JSONB):
+                    continue
+                with engine.connect() as conn:
+                    conn.execute(text(
+                        f'ALTER TABLE {table.name} ALTER COLUMN "{column.name}" '
+                        f'TYPE JSONB USING "{column.name}"::jsonb'
+                    ))
+                    conn.commit()
+        except Exception as e:
+            print(f"Warning: Could not convert {table.name} JSON columns to JSONB: {e}")
+
+
+def _existing_index_names(inspector) -> set:
+    """Names of the indexes in the database, including expression indexes
+    (such as lower(email)), which reflection skips on SQLite."""
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        query = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    elif dialect == "postgresql":
+        query = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+    else:
+        names = set()
+        for table_name in inspector.get_table_names():
+            names.update(ix["name"] for ix in inspector.get_indexes(table_name))
+        return names
+    with engine.connect() as conn:
+        return set(conn.execute(text(query)).scalars())
+
+
+def _ensure_indexes(inspector):
+    """Create model indexes missing from tables that predate them (for existing DBs)."""
+    try:
+        existing = _existing_index_names(inspector)
+    except Exception:
+        existing = set()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                print(f"Warning: Could not ensure index {index.name}: {e}")
+    _reset_index_names()
+
+
+# Indexes actually in the database, loaded on first use. Upserts check for
+# the unique index their ON CONFLICT targets, which is missing when creating
+# it failed (duplicate rows from before it existed) or AUTO_MIGRATE is off on
+# an older schema.
+_index_names: Optional[set] = None
+
+
+def _reset_index_names():
+    global _index_names
+    _index_names = None
+
+
+def has_index(name: str) -> bool:
+    global _index_names
+    if _index_names is None:
+        try:
+            _index_names = _existing_index_names(inspect(engine))
+        except Exception as e:
+            print(f"Warning: Could not list indexes: {e}")
+            return False
+    return name in _index_names
@@ -1,14 +1,21 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from contextlib import asynccontextmanager
 from app.api import auth, courses, chat, processing_status
-from app.database import init_db
-from app.core.config import settings
+from app.database import AsyncSessionLocal, init_db
+from app.models.schemas import ChatSession
+from app.core.config import get_settings, settings
+from app.services.document_processor import shutdown_extract_pool
+from app.services.gemini_service import gemini_service
+from app.services.vector_store import vector_store
+from app.services.task_queue import close_task_queue
 from app.utils.logging_config import get_logger
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+from sqlalchemy import func, select
+import asyncio
 import uvicorn
 import os
 
@@ -17,6 +24,44 @@ logger = get_logger("main")
 # Rate limiter
 limiter = Limiter(key_func=get_remote_address)
 
+# Startup warm-up: the Gemini connection, plus the vector indexes of the
+# courses with the most recent chat sessions; bounded so a slow or
+# unreachable dependency only delays startup by WARMUP_TIMEOUT seconds
+WARMUP_COURSES = int(os.getenv("WARMUP_COURSES", "20"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "15"))
+
+
+async def _recent_course_ids(limit: int) -> list:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(ChatSession.course_id)
+            .where(ChatSession.course_id.is_not(None))
+            .group_by(ChatSession.course_id)
+            .order_by(func.max(ChatSession.id).desc())
+            .limit(limit)
+        )
+        return result.scalars().all()
+
+
+async def warm_up() -> None:
+    """Pay connection and index-load costs before the first request does."""
+    async def warm_vector_store():
+        if WARMUP_COURSES > 0:
+            await vector_store.warm_up(await _recent_course_ids(WARMUP_COURSES))
+
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(gemini_service.warm_up(), warm_vector_store(), return_exceptions=True),
+            WARMUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Warm-up did not finish within {WARMUP_TIMEOUT}s")
+        return
+    for error in results:
+        if isinstance(error, Exception):
+            logger.warning(f"Warm-up step failed: {error}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
@@ -24,13 +69,18 @@ async def lifespan(app: FastAPI):
     logger.info(f"Environment: {settings.ENVIRONMENT}")
     init_db()
     logger.info("Database initialized (PostgreSQL)")
+    await warm_up()
     yield
     # Shutdown
     logger.info(f"Shutting down {settings.PROJECT_NAME} API...")
+    auth.shutdown_hash_pool()
+    shutdown_extract_pool()
+    await close_task_queue()
 
 app = FastAPI(
     title=settings.PROJECT_NAME, 
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/docs" if settings.DEBUG else None,
     redoc_url="/redoc" if settings.DEBUG else None,
 )
@@ -48,10 +98,8 @@ origins = [
     "http://localhost:8000",
 ]
 
-# Also check environment variable
-cors_origins_env = os.environ.get("CORS_ORIGINS_STR", "")
-if cors_origins_env:
-    origins.extend([o.strip() for o in cors_origins_env.split(",") if o.strip()])
+# Plus any configured via CORS_ORIGINS_STR (parsed once by Settings)
+origins.extend(get_settings().CORS_ORIGINS)
 
 # Remove duplicates
 origins = list(set(origins))
@@ -79,6 +127,15 @@ app.include_router(courses.router)
 app.include_router(chat.router)
 app.include_router(processing_status.router)
 
+# Fail fast if two routers register the same method + path
+_route_keys = [
+    (route.path, method)
+    for route in app.routes
+    for method in (getattr(route, "methods", None) or {""})
+]
+if len(_route_keys) != len(set(_route_keys)):
+    raise RuntimeError("Duplicate API routes registered")
+
 @app.get("/")
 def read_root():
     return {"message": f"{settings.PROJECT_NAME} API", "status": "healthy"}
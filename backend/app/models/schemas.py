@@ -1,10 +1,15 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, JSON, Boolean
+from sqlalchemy import func, text, Column, Integer, String, DateTime, ForeignKey, Text, JSON, Boolean, Index, LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from app.utils.compression import decompress_text
 
 Base = declarative_base()
 
+# Binary JSONB on PostgreSQL (parsed once on write, indexable); plain JSON elsewhere
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
 class User(Base):
     __tablename__ = "users"
     
@@ -14,11 +19,20 @@ class User(Base):
     password_hash = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    # Emails are stored lowercased; this backs case-insensitive lookups
+    __table_args__ = (
+        Index("ix_users_email_lower", func.lower(email), unique=True),
+    )
+    
     courses = relationship("Course", back_populates="user")
     sessions = relationship("ChatSession", back_populates="user")
 
 class Course(Base):
     __tablename__ = "courses"
+    __table_args__ = (
+        # Course listing and ownership checks filter by user
+        Index("ix_courses_user", "user_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -29,9 +43,23 @@ class Course(Base):
     user = relationship("User", back_populates="courses")
     units = relationship("Unit", back_populates="course")
     sessions = relationship("ChatSession", back_populates="course")
+    uploaded_files = relationship("UploadedFile", back_populates="course")
 
 class Unit(Base):
     __tablename__ = "units"
+    __table_args__ = (
+        # One topic unit per name in a course; lets uploads upsert by topic_name
+        Index(
+            "uq_units_course_topic_name", "course_id", "name",
+            unique=True,
+            postgresql_where=text("level = 1"),
+            sqlite_where=text("level = 1"),
+        ),
+        # Structure tree (WHERE course_id ORDER BY order) and next-order lookups
+        Index("ix_units_course_order", "course_id", "order"),
+        # Unit.children lookups by parent
+        Index("ix_units_parent", "parent_unit_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     course_id = Column(Integer, ForeignKey("courses.id"))
@@ -42,30 +70,41 @@ class Unit(Base):
     summary = Column(Text, nullable=True)
     
     course = relationship("Course", back_populates="units")
-    parent = relationship("Unit", remote_side=[id], backref="children")
+    parent = relationship("Unit", remote_side=[id], back_populates="children")
+    children = relationship("Unit", back_populates="parent")
     documents = relationship("Document", back_populates="unit")
 
 class Document(Base):
     __tablename__ = "documents"
+    __table_args__ = (
+        Index("ix_documents_unit", "unit_id"),
+        # Containment (@>) filters on chunk metadata; PostgreSQL only
+        Index("ix_documents_metadata_gin", "doc_metadata", postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     unit_id = Column(Integer, ForeignKey("units.id"))
     content = Column(Text)
     chunk_type = Column(String)
-    doc_metadata = Column(JSON)  # Renamed from 'metadata' to avoid conflict
+    doc_metadata = Column(JSONType)  # Renamed from 'metadata' to avoid conflict
     vector_id = Column(String)
     
     unit = relationship("Unit", back_populates="documents")
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
+    __table_args__ = (
+        Index("ix_session_user_course", "user_id", "course_id"),
+        # delete_course filters sessions by course alone
+        Index("ix_session_course", "course_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     course_id = Column(Integer, ForeignKey("courses.id"))
     current_unit_id = Column(Integer, ForeignKey("units.id"), nullable=True)
     teaching_mode = Column(String, default="qa")
-    context = Column(JSON)
+    context = Column(JSONType)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="sessions")
@@ -74,31 +113,52 @@ class ChatSession(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_message_session_ts", "session_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(Integer, ForeignKey("chat_sessions.id"))
     role = Column(String)
     content = Column(Text)
-    msg_metadata = Column(JSON)  # Renamed from 'metadata' to avoid conflict
+    msg_metadata = Column(JSONType)  # Renamed from 'metadata' to avoid conflict
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     session = relationship("ChatSession", back_populates="messages")
 
 class UploadedFile(Base):
     __tablename__ = "uploaded_files"
+    __table_args__ = (
+        # One copy of a given file per course; also backs the dedup lookup
+        Index("uq_uploaded_files_course_hash", "course_id", "text_hash", unique=True),
+        # Cross-course lookup of an earlier extraction of the same bytes
+        Index("ix_uploaded_files_text_hash", "text_hash"),
+        # Polled status listing: filter by course, newest first
+        Index("ix_uploaded_files_course_uploaded", "course_id", "uploaded_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     course_id = Column(Integer, ForeignKey("courses.id"))
     filename = Column(String)
     original_filename = Column(String)
     file_size = Column(Integer)  # Size in bytes
-    # Store extracted text to avoid persisting original files
+    # Store extracted text to avoid persisting original files; new rows keep
+    # it zstd-compressed, extracted_text is only set on older rows
     extracted_text = Column(Text, nullable=True)
-    text_hash = Column(String(64), nullable=True)
+    extracted_text_zst = Column(LargeBinary, nullable=True)
+    # BLAKE3 (256-bit hex) of the uploaded file bytes (column keeps its original name)
+    content_hash = Column("text_hash", String(64), nullable=True)
     processing_status = Column(String(20), default="pending")
     # Deprecated: file path kept for backward compatibility
     file_path = Column(String, nullable=True)
     chunks_count = Column(Integer, default=0)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     
-    course = relationship("Course", backref="uploaded_files")
+    course = relationship("Course", back_populates="uploaded_files")
+    
+    @property
+    def text(self) -> str:
+        """Extracted text, from whichever column holds it."""
+        if self.extracted_text_zst is not None:
+            return decompress_text(self.extracted_text_zst)
+        return self.extracted_text or ""
@@ -1,10 +1,38 @@
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+import asyncio
+import os
 import re
 import zipfile
-import xml.etree.ElementTree as ET
-from typing import List, Dict
+from typing import BinaryIO, Iterator, List, Dict, Optional, Tuple
 
-import PyPDF2
+import numpy as np
+import pypdfium2 as pdfium
+from lxml import etree
+
+try:
+    # Native sentence segmenter; also keeps abbreviations like "e.g." intact
+    from blingfire import text_to_sentences
+except ImportError:  # pragma: no cover - regex fallback below
+    text_to_sentences = None
+
+# PDF/DOCX/PPTX parsing and chunking are CPU-bound and hold the GIL, so they
+# run in worker processes; the pool is started on first use
+EXTRACT_WORKERS = os.cpu_count() or 1
+_extract_pool: Optional[ProcessPoolExecutor] = None
+_extract_slots = asyncio.Semaphore(EXTRACT_WORKERS * 2)
+
+# Pages extracted per pool task for large PDFs; each task reopens the
+# document, so ranges rather than single pages keep that overhead small
+PDF_PAGES_PER_TASK = 16
+
+# Text runs in WordprocessingML and DrawingML (slides); all other elements
+# are markup
+_DOCX_TEXT_TAG = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t"
+_PPTX_TEXT_TAG = "{http://schemas.openxmlformats.org/drawingml/2006/main}t"
+
+_WS_RE = re.compile(r"\s+")
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
 
 
 class DocumentProcessor:
@@ -14,89 +42,177 @@ class DocumentProcessor:
         self.overlap = 200      # words
 
     async def extract_text_from_bytes(self, content: bytes, filename: str) -> str:
-        """Extract text from file bytes without persisting to disk."""
+        """Extract text from file bytes in the extraction process pool."""
+        if filename.lower().split('.')[-1] == 'pdf':
+            return await self._extract_pdf_parallel(content)
+        return await _run_in_pool(_extract_text, content, filename)
+
+    async def _extract_pdf_parallel(self, content: bytes) -> str:
+        """Extract a PDF with its page ranges spread across the process pool."""
+        # The first task also reports the page count, so short PDFs
+        # take a single round trip
+        first, page_count = await _run_in_pool(
+            _extract_pdf_pages, content, 0, PDF_PAGES_PER_TASK
+        )
+        if page_count <= PDF_PAGES_PER_TASK:
+            return first
+
+        rest = await asyncio.gather(*(
+            _run_in_pool(_extract_pdf_pages, content, start, start + PDF_PAGES_PER_TASK)
+            for start in range(PDF_PAGES_PER_TASK, page_count, PDF_PAGES_PER_TASK)
+        ))
+        return first + "".join(text for text, _ in rest)
+
+    async def create_semantic_chunks_async(self, text: str, metadata: Dict) -> List[Dict]:
+        """create_semantic_chunks in the process pool; regex splitting of a
+        long document would otherwise hold the event loop."""
+        return await _run_in_pool(_create_chunks, text, metadata)
+
+    async def extract_text_from_stream(self, stream: BinaryIO, filename: str) -> str:
+        """Extract text from a seekable binary file object (e.g. a spooled upload)."""
+        # File objects can't cross the process boundary, so hand over its bytes
+        stream.seek(0)
+        return await self.extract_text_from_bytes(stream.read(), filename)
+
+    def extract_text_sync(self, stream: BinaryIO, filename: str) -> str:
+        """Extract text in the calling thread; CPU-bound, keep off the event loop."""
         ext = filename.lower().split('.')[-1]
 
         if ext == 'pdf':
-            return await self._extract_pdf_bytes(content)
+            return self._extract_pdf(stream)
         if ext == 'docx':
-            return await self._extract_docx_bytes(content)
+            return self._extract_docx(stream)
         if ext == 'pptx':
-            return await self._extract_pptx_bytes(content)
+            return self._extract_pptx(stream)
 
         raise ValueError(f"Unsupported file type: {ext}")
 
-    async def _extract_pdf_bytes(self, content: bytes) -> str:
-        """Extract text from PDF bytes."""
-        reader = PyPDF2.PdfReader(BytesIO(content))
-        text_parts: List[str] = []
+    def _extract_pdf(self, stream: BinaryIO) -> str:
+        """Extract text from a PDF file object (PDFium, native code)."""
+        text, _ = self._extract_pdf_pages(stream, 0, None)
+        return text
 
-        for page_num, page in enumerate(reader.pages):
-            page_text = page.extract_text() or ""
-            text_parts.append(f"\n--- Page {page_num + 1} ---\n{page_text}")
-
-        return "".join(text_parts)
+    def _extract_pdf_pages(self, source, start: int, stop: Optional[int]) -> Tuple[str, int]:
+        """Extract pages [start, stop) of a PDF (file object or bytes);
+        returns the text and the total page count."""
+        pdf = pdfium.PdfDocument(source)
+        text_parts: List[str] = []
 
-    async def _extract_docx_bytes(self, content: bytes) -> str:
-        """Extract text from DOCX bytes."""
+        try:
+            page_count = len(pdf)
+            for page_num in range(start, min(page_count, stop or page_count)):
+                page = pdf[page_num]
+                textpage = page.get_textpage()
+                try:
+                    page_text = textpage.get_text_range()
+                finally:
+                    textpage.close()
+                    page.close()
+                text_parts.append(f"\n--- Page {page_num + 1} ---\n{page_text}")
+        finally:
+            pdf.close()
+
+        return "".join(text_parts), page_count
+
+    def _extract_docx(self, stream: BinaryIO) -> str:
+        """Extract text from a DOCX file object."""
         text_parts: List[str] = []
-        with zipfile.ZipFile(BytesIO(content)) as docx:
-            xml_content = docx.read('word/document.xml')
-            root = ET.fromstring(xml_content)
-            for elem in root.iter():
-                if elem.text:
-                    text_parts.append(elem.text)
+        with zipfile.ZipFile(stream) as docx, docx.open('word/document.xml') as xml_file:
+            for text in _iter_xml_text(xml_file, _DOCX_TEXT_TAG):
+                text_parts.append(text)
         return " ".join(text_parts)
 
-    async def _extract_pptx_bytes(self, content: bytes) -> str:
-        """Extract text from PPTX bytes."""
+    def _extract_pptx(self, stream: BinaryIO) -> str:
+        """Extract text from a PPTX file object."""
         text_parts: List[str] = []
-        with zipfile.ZipFile(BytesIO(content)) as pptx:
+        with zipfile.ZipFile(stream) as pptx:
             for name in pptx.namelist():
                 if name.startswith('ppt/slides/slide') and name.endswith('.xml'):
-                    xml_content = pptx.read(name)
-                    root = ET.fromstring(xml_content)
-                    for elem in root.iter():
-                        if elem.text and elem.text.strip():
-                            text_parts.append(elem.text.strip())
+                    with pptx.open(name) as xml_file:
+                        for text in _iter_xml_text(xml_file, _PPTX_TEXT_TAG):
+                            if text.strip():
+                                text_parts.append(text.strip())
         return "\n".join(text_parts)
 
     def create_semantic_chunks(self, text: str, metadata: Dict) -> List[Dict]:
         """Create sentence-aware overlapping chunks for embeddings."""
-        cleaned = re.sub(r"\s+", " ", text).strip()
-        sentences = re.split(r'(?<=[.!?])\s+', cleaned)
+        cleaned = _WS_RE.sub(" ", text).strip()
+        if text_to_sentences is not None:
+            sentences = text_to_sentences(cleaned).split("\n")
+        else:
+            sentences = _SENT_RE.split(cleaned)
 
         chunks: List[Dict] = []
-        current_chunk: List[str] = []
-        current_length = 0
-
-        for sentence in sentences:
-            sentence_length = len(sentence.split())
-
-            if current_length + sentence_length > self.chunk_size:
-                if current_chunk:
-                    chunk_text = ' '.join(current_chunk)
-                    chunks.append({
-                        "content": chunk_text,
-                        "metadata": {**metadata, "chunk_index": len(chunks)}
-                    })
-
-                # Maintain overlap to preserve context
-                overlap_words = self.overlap
-                current_chunk = current_chunk[-overlap_words:] if overlap_words > 0 else []
-                current_length = len(' '.join(current_chunk).split())
-
-            current_chunk.append(sentence)
-            current_length += sentence_length
-
-        if current_chunk:
-            chunk_text = ' '.join(current_chunk)
+        # Prefix sums of sentence word counts: words in sentences [a, b) are
+        # cum[b] - cum[a], so chunk edges come from binary searches
+        word_counts = np.fromiter(
+            (len(sentence.split()) for sentence in sentences),
+            dtype=np.int64,
+            count=len(sentences)
+        )
+        cum = np.concatenate(([0], np.cumsum(word_counts)))
+        n = len(sentences)
+
+        start = 0
+        forced = 0  # sentence the chunk must include, even if that overflows it
+        while True:
+            # Longest run from start that fits chunk_size, but at least through `forced`
+            fits = int(np.searchsorted(cum, cum[start] + self.chunk_size, side="right")) - 1
+            end = max(forced + 1, fits)
             chunks.append({
-                "content": chunk_text,
+                "content": ' '.join(sentences[start:end]),
                 "metadata": {**metadata, "chunk_index": len(chunks)}
             })
+            if end >= n:
+                break
+
+            # Maintain overlap to preserve context: the next chunk starts with
+            # trailing sentences totalling at most self.overlap words
+            start = max(start, int(np.searchsorted(cum, cum[end] - self.overlap, side="left")))
+            forced = end
 
         return chunks
 
 
+def _iter_xml_text(xml_file: BinaryIO, tag: str) -> Iterator[str]:
+    """Yield the text of each `tag` element, parsing incrementally with
+    libxml2; other elements are skipped by the parser, not in Python."""
+    for _, elem in etree.iterparse(xml_file, events=("end",), tag=tag):
+        if elem.text:
+            yield elem.text
+        elem.clear(keep_tail=True)
+
+
 document_processor = DocumentProcessor()
+
+
+async def _run_in_pool(fn, *args):
+    """Run fn(*args) in the extraction process pool, starting it on first use."""
+    global _extract_pool
+    async with _extract_slots:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_extract_pool, fn, *args)
+
+
+# Process-pool entry points; module-level so they can be pickled
+
+def _extract_text(content: bytes, filename: str) -> str:
+    return document_processor.extract_text_sync(BytesIO(content), filename)
+
+
+def _extract_pdf_pages(content: bytes, start: int, stop: int) -> Tuple[str, int]:
+    return document_processor._extract_pdf_pages(content, start, stop)
+
+
+def _create_chunks(text: str, metadata: Dict) -> List[Dict]:
+    return document_processor.create_semantic_chunks(text, metadata)
+
+
+def shutdown_extract_pool() -> None:
+    """Stop the extraction process pool, if it was started."""
+    global _extract_pool
+    if _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+        _extract_pool = None
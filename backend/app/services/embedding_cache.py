@@ -0,0 +1,53 @@
+"""Local persistent embedding cache (SQLite), used when no Redis is configured"""
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "./storage/embedding_cache.db")
+
+# SQLite caps bound parameters per statement; look keys up in slices this size
+_MAX_KEYS_PER_SELECT = 500
+
+
+class EmbeddingCache:
+    """Packed float32 vectors by cache key in a single-table SQLite file.
+
+    Calls block on disk I/O; run them in a thread from async code.
+    """
+
+    def __init__(self, path: str = EMBED_CACHE_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS emb (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Stored vectors aligned with keys, None where missing."""
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(keys), _MAX_KEYS_PER_SELECT):
+                batch = keys[i:i + _MAX_KEYS_PER_SELECT]
+                placeholders = ",".join("?" * len(batch))
+                found.update(conn.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", batch
+                ))
+        return [found.get(key) for key in keys]
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO emb (key, vec) VALUES (?, ?)", items.items())
+
+
+embedding_cache = EmbeddingCache()
@@ -1,15 +1,63 @@
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 import os
-import time
-import hashlib
+import re
+import json
+import asyncio
+from array import array
 from collections import OrderedDict
+from typing import List, Optional
+import httpx
+from aiolimiter import AsyncLimiter
+from blake3 import blake3
 from dotenv import load_dotenv
+from app.core.config import settings
+from app.services.embedding_cache import embedding_cache
+from app.services.task_queue import get_redis_pool
 from app.utils.logging_config import get_logger
 
 load_dotenv()
 logger = get_logger("gemini_service")
 
+# Retry hint in rate-limit errors, e.g. "... Please retry in 12s"
+_RETRY_IN_RE = re.compile(r'retry in (\d+)')
+
+# Shared across all Gemini calls in the process: requests in flight, and a
+# token bucket so bursts queue here instead of coming back as 429s
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+_gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+_gemini_limiter = AsyncLimiter(GEMINI_REQUESTS_PER_MINUTE, 60)
+
+# Structured-output schema for classify_query_intent
+QUERY_INTENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {
+            "type": "string",
+            "enum": ["teach_sequential", "explain_concept", "quiz", "mindmap", "clarify"]
+        },
+        "target_units": {"type": "array", "items": {"type": "string"}},
+        "detail_level": {"type": "string", "enum": ["high", "medium", "low"]}
+    },
+    "required": ["intent", "target_units", "detail_level"]
+}
+
+# Persistent embedding cache: float32 vectors, in Redis under this prefix
+# (or in the local SQLite cache without Redis)
+EMBED_CACHE_PREFIX = "emb:"
+EMBED_CACHE_TTL = 30 * 24 * 3600  # seconds
+
+
+def _pack_embedding(values: list) -> bytes:
+    return array("f", values).tobytes()
+
+
+def _unpack_embedding(blob: bytes) -> list:
+    values = array("f")
+    values.frombytes(blob)
+    return values.tolist()
+
 class RateLimitError(Exception):
     """Raised when API rate limit is exceeded"""
     def __init__(self, message, retry_after=60):
@@ -17,6 +65,27 @@ class RateLimitError(Exception):
         self.retry_after = retry_after
         super().__init__(self.message)
 
+def _rate_limit_retry_after(error: Exception) -> Optional[int]:
+    """Seconds to wait if error is a rate-limit (429 / quota) error, else None."""
+    error_str = str(error)
+    if "429" not in error_str and "RESOURCE_EXHAUSTED" not in error_str:
+        return None
+    match = _RETRY_IN_RE.search(error_str.lower())
+    return int(match.group(1)) if match else 60
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a failed call is worth retrying: rate limits, server errors,
+    and transport failures or timeouts. Anything else (bad request, auth,
+    safety blocks, bugs) would fail the same way again."""
+    if isinstance(error, errors.APIError):
+        code = error.code or 0
+        return code == 429 or code >= 500
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    return _rate_limit_retry_after(error) is not None
+
+
 class GeminiService:
     def __init__(self):
         # Initialize the new google.genai client
@@ -28,60 +97,64 @@ class GeminiService:
         self._cache_max_items = 1000
         logger.info(f"GeminiService initialized with model: {self.model_name}")
     
-    async def generate_text(self, prompt: str, system_instruction: str = None, max_retries: int = 2) -> str:
-        """Generate text using Gemini 2.5 Flash with retry logic"""
-        last_error = None
-        
+    async def _call_with_retry(self, call, max_retries: int = 2):
+        """Await ``call()`` under the shared concurrency and rate limits,
+        retrying transient failures with backoff; 429s that outlast the
+        retries raise RateLimitError, other errors are raised at once."""
         for attempt in range(max_retries + 1):
             try:
-                logger.debug(f"Generating text with prompt length: {len(prompt)} (attempt {attempt + 1})")
-                config = types.GenerateContentConfig(
-                    system_instruction=system_instruction
-                ) if system_instruction else None
-                
-                response = self.client.models.generate_content(
-                    model=self.model_name,
-                    contents=prompt,
-                    config=config
-                )
-                logger.debug(f"Generated response length: {len(response.text)}")
-                return response.text
+                async with _gemini_slots, _gemini_limiter:
+                    return await call()
             except Exception as e:
-                error_str = str(e)
-                logger.error(f"Error generating text (attempt {attempt + 1}): {e}")
-                
-                # Check for rate limit error
-                if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                    # Extract retry delay if available
-                    retry_after = 60
-                    if "retry in" in error_str.lower():
-                        try:
-                            import re
-                            match = re.search(r'retry in (\d+)', error_str.lower())
-                            if match:
-                                retry_after = int(match.group(1))
-                        except:
-                            pass
-                    
-                    if attempt < max_retries:
-                        wait_time = min(retry_after, 30)  # Wait max 30 seconds between retries
-                        logger.info(f"Rate limited. Waiting {wait_time}s before retry...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
+                logger.error(f"Gemini API error (attempt {attempt + 1}): {e}")
+                if not _is_transient(e):
+                    raise
+                retry_after = _rate_limit_retry_after(e)
+
+                if attempt == max_retries:
+                    if retry_after is not None:
                         raise RateLimitError(
                             f"API rate limit exceeded. The free tier allows 20 requests per minute. Please wait {retry_after} seconds.",
                             retry_after
-                        )
-                
-                last_error = e
-                if attempt < max_retries:
-                    time.sleep(2)  # Brief pause before retry for other errors
-                    continue
-                raise
-        
-        if last_error:
-            raise last_error
+                        ) from e
+                    raise
+
+                # Honour the server's retry hint (capped) for 429s, otherwise back off exponentially
+                wait_time = min(retry_after, 30) if retry_after is not None else 2 ** attempt
+                logger.info(f"Waiting {wait_time}s before retry...")
+                await asyncio.sleep(wait_time)
+    
+    async def generate_text(
+        self,
+        prompt: str,
+        system_instruction: str = None,
+        max_retries: int = 2,
+        response_schema: Optional[dict] = None
+    ) -> str:
+        """Generate text using Gemini 2.5 Flash with retry logic.
+
+        With response_schema the model returns JSON matching that schema.
+        """
+        logger.debug("Generating text with prompt length: %d", len(prompt))
+        config = None
+        if system_instruction or response_schema:
+            config = types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                response_mime_type="application/json" if response_schema else None,
+                response_schema=response_schema
+            )
+
+        # Native async client, so the request doesn't block the event loop
+        response = await self._call_with_retry(
+            lambda: self.client.aio.models.generate_content(
+                model=self.model_name,
+                contents=prompt,
+                config=config
+            ),
+            max_retries
+        )
+        logger.debug("Generated response length: %d", len(response.text))
+        return response.text
     
     async def generate_streaming(self, prompt: str, system_instruction: str = None):
         """Generate text with streaming"""
@@ -90,42 +163,109 @@ class GeminiService:
                 system_instruction=system_instruction
             ) if system_instruction else None
             
-            for chunk in self.client.models.generate_content_stream(
-                model=self.model_name,
-                contents=prompt,
-                config=config
-            ):
+            # Only opening the stream counts against the shared limits; reading
+            # it (paced by the client) must not hold a slot other calls need
+            async with _gemini_slots, _gemini_limiter:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=self.model_name,
+                    contents=prompt,
+                    config=config
+                )
+            async for chunk in stream:
                 if chunk.text:
                     yield chunk.text
-        except Exception as e:
-            print(f"Error in streaming: {e}")
+        except Exception:
+            logger.exception("Error in streaming")
             raise
     
+    def _embedding_key(self, text: str) -> str:
+        # The model is part of the key so switching models never serves stale vectors
+        return blake3(f"{self.embedding_model}\0{text}".encode()).hexdigest(length=16)
+
     async def generate_embedding(self, text: str) -> list:
-        """Generate embedding for text with in-memory LRU caching."""
-        cache_key = hashlib.md5(text.encode()).hexdigest()
+        """Generate embedding for text, served from the caches when possible."""
+        return (await self.generate_embeddings([text]))[0]
+    
+    async def generate_embeddings(self, texts: List[str]) -> List[list]:
+        """Embed several texts with one API call.
 
-        if cache_key in self._embedding_cache:
-            embedding = self._embedding_cache.pop(cache_key)
-            self._embedding_cache[cache_key] = embedding
-            return embedding
+        Lookups go through the in-process LRU, then the persistent cache
+        (Redis when REDIS_URL is set, shared with the worker; otherwise the
+        local SQLite file), so re-ingesting content reuses its vectors;
+        only the remaining misses reach the API.
+        """
+        keys = [self._embedding_key(text) for text in texts]
+        embeddings: List[Optional[list]] = [None] * len(texts)
+        misses: List[int] = []
 
-        try:
-            result = self.client.models.embed_content(
-                model=self.embedding_model,
-                contents=text
+        for i, cache_key in enumerate(keys):
+            if cache_key in self._embedding_cache:
+                self._embedding_cache.move_to_end(cache_key)
+                embeddings[i] = self._embedding_cache[cache_key]
+            else:
+                misses.append(i)
+
+        if misses:
+            stored = await self._stored_get_embeddings([keys[i] for i in misses])
+            remaining = []
+            for i, blob in zip(misses, stored):
+                if blob is None:
+                    remaining.append(i)
+                else:
+                    embeddings[i] = _unpack_embedding(blob)
+                    self._embedding_cache[keys[i]] = embeddings[i]
+            misses = remaining
+
+        if misses:
+            contents = [texts[i] for i in misses]
+            result = await self._call_with_retry(
+                lambda: self.client.aio.models.embed_content(
+                    model=self.embedding_model,
+                    contents=contents
+                )
             )
-            embedding = result.embeddings[0].values
 
-            self._embedding_cache[cache_key] = embedding
-            if len(self._embedding_cache) > self._cache_max_items:
-                # Evict oldest item
-                self._embedding_cache.popitem(last=False)
+            for i, item in zip(misses, result.embeddings):
+                embeddings[i] = item.values
+                self._embedding_cache[keys[i]] = item.values
+            await self._stored_set_embeddings({keys[i]: embeddings[i] for i in misses})
+
+        while len(self._embedding_cache) > self._cache_max_items:
+            # Evict oldest items
+            self._embedding_cache.popitem(last=False)
+
+        return embeddings
 
-            return embedding
+    async def _stored_get_embeddings(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Read persisted vectors; a cache outage only costs API calls."""
+        try:
+            if not settings.REDIS_URL:
+                return await asyncio.to_thread(embedding_cache.get_many, keys)
+            pool = await get_redis_pool()
+            return await pool.mget([EMBED_CACHE_PREFIX + key for key in keys])
         except Exception as e:
-            print(f"Error generating embedding: {e}")
-            raise
+            logger.warning(f"Embedding cache read failed: {e}")
+            return [None] * len(keys)
+
+    async def _stored_set_embeddings(self, items: dict) -> None:
+        packed = {key: _pack_embedding(embedding) for key, embedding in items.items()}
+        try:
+            if not settings.REDIS_URL:
+                await asyncio.to_thread(embedding_cache.set_many, packed)
+                return
+            pool = await get_redis_pool()
+            pipe = pool.pipeline(transaction=False)
+            for key, blob in packed.items():
+                pipe.set(EMBED_CACHE_PREFIX + key, blob, ex=EMBED_CACHE_TTL)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+    
+    async def warm_up(self) -> None:
+        """Open the API connection and the persistent embedding cache ahead
+        of the first request. Reads model metadata, so no quota is spent."""
+        await self.client.aio.models.get(model=self.embedding_model)
+        await self._stored_get_embeddings([self._embedding_key("")])
     
     async def classify_query_intent(self, query: str, context: dict) -> dict:
         """Classify user query intent"""
@@ -146,18 +286,13 @@ Also identify:
 - target_units: Which units/sections are relevant (list)
 - detail_level: high/medium/low
 
-Respond ONLY with JSON:
-{{"intent": "...", "target_units": [...], "detail_level": "..."}}"""
+Respond with JSON."""
 
-        response = await self.generate_text(prompt)
-        import json
+        # Structured output: the model's reply is the JSON object itself
+        response = await self.generate_text(prompt, response_schema=QUERY_INTENT_SCHEMA)
         try:
-            # Extract JSON from response
-            json_start = response.find('{')
-            json_end = response.rfind('}') + 1
-            json_str = response[json_start:json_end]
-            return json.loads(json_str)
-        except:
+            return json.loads(response)
+        except ValueError:
             return {"intent": "explain_concept", "target_units": [], "detail_level": "medium"}
 
 gemini_service = GeminiService()
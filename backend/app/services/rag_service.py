@@ -1,99 +1,25 @@
-from typing import List, Dict
-from app.services.vector_store import vector_store
+import re
+from bisect import bisect_right
+from typing import Dict, List, NamedTuple, Tuple
+from cachetools import TTLCache
+from app.services.vector_store import normalize_query, vector_store
 from app.services.gemini_service import gemini_service
 from app.utils.logging_config import get_logger
 
 logger = get_logger("rag_service")
 
-class RAGService:
-    
-    async def retrieve_context(
-        self,
-        course_id: int,
-        query: str,
-        session_context: Dict
-    ) -> List[Dict]:
-        """Main retrieval function - simple semantic search"""
-        
-        logger.info(f"Retrieving context for query: {query[:100]}...")
-        
-        # Simple query - just find relevant chunks by semantic similarity
-        # No complex filtering that might exclude results
-        results = await vector_store.query(
-            course_id=course_id,
-            query_text=query,
-            n_results=10,
-            where=None  # No filtering - let semantic search do the work
-        )
-        
-        logger.info(f"Retrieved {len(results.get('documents', [[]])[0])} chunks")
-        
-        # Format results
-        chunks = []
-        if results and results.get("documents"):
-            for i, doc in enumerate(results["documents"][0]):
-                chunks.append({
-                    "content": doc,
-                    "metadata": results["metadatas"][0][i] if results.get("metadatas") else {},
-                    "distance": results["distances"][0][i] if results.get("distances") else 0
-                })
-        
-        logger.debug(f"Formatted {len(chunks)} chunks for response generation")
-        return chunks
-    
-    async def generate_response(
-        self,
-        query: str,
-        retrieved_chunks: List[Dict],
-        session_context: Dict,
-        course_name: str
-    ) -> str:
-        """Generate response using retrieved context with strict grounding."""
-
-        logger.info(f"Generating response for: {query[:100]}...")
-        logger.info(f"Using {len(retrieved_chunks)} context chunks")
-
-        query_lower = query.lower()
-        is_simple_query = len(query.split()) < 10 and not any(
-            word in query_lower for word in [
-                'explain', 'describe', 'compare', 'analyze', 'list',
-                'all', 'everything', 'detail', 'how', 'why'
-            ]
-        )
-        is_comprehensive_query = any(
-            word in query_lower for word in [
-                'everything', 'all', 'comprehensive', 'detailed', 'complete', 'full'
-            ]
-        )
-
-        if retrieved_chunks:
-            num_chunks = 3 if is_simple_query else 6
-            context_parts = []
-            for i, chunk in enumerate(retrieved_chunks[:num_chunks], 1):
-                source = chunk['metadata'].get('source', chunk['metadata'].get('unit_name', 'Document'))
-                distance = chunk.get('distance', 0)
-                relevance = "HIGH" if distance < 0.5 else "MEDIUM" if distance < 1.0 else "LOW"
-                context_parts.append(
-                    f"[Source {i}: {source}] [Relevance: {relevance}]\n{chunk['content']}"
-                )
-            context_text = "\n\n---\n\n".join(context_parts)
-        else:
-            context_text = "NO CONTEXT AVAILABLE"
-
-        if is_simple_query:
-            length_instruction = "Keep your answer concise - 2-3 sentences for simple factual questions."
-        elif is_comprehensive_query:
-            length_instruction = "Provide a thorough answer with examples, but only from the provided sources."
-        else:
-            length_instruction = "Match response length to question complexity. Be thorough but not verbose."
-
-        has_relevant_context = False
-        if retrieved_chunks:
-            min_distance = min(chunk.get('distance', 999) for chunk in retrieved_chunks)
-            has_relevant_context = min_distance < 1.2 and len(retrieved_chunks) > 0
+# Query words that steer answer length, matched as whole words
+_WORD_RE = re.compile(r"\w+")
+_COMPLEX_QUERY_WORDS = frozenset({
+    'explain', 'describe', 'compare', 'analyze', 'list',
+    'all', 'everything', 'detail', 'how', 'why'
+})
+_COMPREHENSIVE_QUERY_WORDS = frozenset({
+    'everything', 'all', 'comprehensive', 'detailed', 'complete', 'full'
+})
 
-        if has_relevant_context:
-            system_instruction = f"""You are an AI tutor for: {course_name}.
+# Prompt templates, filled per request with str.format
+_GROUNDED_SYSTEM_TMPL = """You are an AI tutor for: {course_name}.
 ## CRITICAL RULES - FOLLOW EXACTLY:
 1. ONLY use information from the provided context blocks below
 2. If the context doesn't contain specific information, say "The provided materials don't cover this specifically" - do not make up information
@@ -111,7 +37,7 @@ class RAGService:
 - For comparisons: only compare aspects covered in the sources
 - Avoid speculation; if unsure, say so explicitly"""
 
-            prompt = f"""## Student's Study Materials:
+_GROUNDED_PROMPT_TMPL = """## Student's Study Materials:
 {context_text}
 ---
 ## Student's Question: "{query}"
@@ -119,9 +45,8 @@ Provide a helpful, grounded answer. Remember:
 - Cite your sources (Source 1, Source 2, etc.)
 - If unsure, say so rather than guessing
 - Stay within what the materials actually say"""
-        else:
-            logger.info("No relevant context found; falling back to general knowledge with disclaimer")
-            system_instruction = f"""You are an AI tutor helping with: {course_name}.
+
+_FALLBACK_SYSTEM_TMPL = """You are an AI tutor helping with: {course_name}.
 ## IMPORTANT NOTICE:
 The student's uploaded materials do NOT contain information about this specific question.
 You MUST be transparent about this.
@@ -136,13 +61,287 @@ You MUST be transparent about this.
 - Be educational and helpful
 - Recommend uploading relevant materials for verified answers"""
 
-            prompt = f"""Student's Question: "{query}"
+_FALLBACK_PROMPT_TMPL = """Student's Question: "{query}"
 The student is studying {course_name} but their uploaded materials don't cover this topic.
 Answer using general knowledge with the required disclaimer."""
 
-        logger.debug(f"Sending prompt to Gemini (length: {len(prompt)})")
+_STREAM_GROUNDED_SYSTEM_TMPL = """You are an AI tutor for: {course_name}.
+Use ONLY the provided context blocks. Cite sources (Source 1, Source 2...). If context seems weak, say so and avoid guessing."""
+
+_STREAM_GROUNDED_PROMPT_TMPL = """## Student's Study Materials:
+{context_text}
+---
+## Student's Question: "{query}"
+Stream a grounded answer. If unsure, say so explicitly."""
+
+_STREAM_FALLBACK_SYSTEM_TMPL = """You are an AI tutor helping with: {course_name}.
+The uploaded materials don't cover this; respond with general knowledge and a clear disclaimer."""
+
+_STREAM_FALLBACK_PROMPT_TMPL = """Student's Question: "{query}"
+No relevant uploaded context found. Start with the disclaimer, then answer concisely."""
+
+# Retrieved chunks by (course_id, normalized query), stored with the course's
+# chunk count at the time; any write to the course (here or in the worker
+# process) changes the count and turns old entries into misses
+_retrieval_cache: TTLCache = TTLCache(maxsize=4096, ttl=600)
+
+# Chunks returned per retrieval, ranked by reciprocal rank fusion (score
+# 1/(RRF_K + rank) summed over the current question's result lists). With a
+# previous question in the session, RETRIEVAL_CANDIDATES are fetched for
+# both in one call; the previous question's ranking only adds
+# PREVIOUS_QUERY_WEIGHT of its score to candidates the current question
+# also found within RELEVANT_DISTANCE, so it can reorder relevant chunks
+# but never bring in chunks that only match the earlier topic
+RETRIEVAL_RESULTS = 10
+RETRIEVAL_CANDIDATES = 20
+RRF_K = 60
+PREVIOUS_QUERY_WEIGHT = 0.5
+
+# Relevance labels by chroma distance: < 0.5 HIGH, < 1.0 MEDIUM, else LOW
+_RELEVANCE_CUTOFFS = (0.5, 1.0)
+_RELEVANCE_LABELS = ("HIGH", "MEDIUM", "LOW")
+# Prompt context budgets (estimated tokens) by query type; Gemini latency
+# grows with input size, so context is packed to a budget, not a chunk count
+SIMPLE_CONTEXT_TOKENS = 2000
+CONTEXT_TOKENS = 4000
+COMPREHENSIVE_CONTEXT_TOKENS = 8000
+# Answers are grounded in the materials only if some chunk is this close
+RELEVANT_DISTANCE = 1.2
+# Chunks further than this are left out of the prompt altogether
+MAX_CONTEXT_DISTANCE = 1.5
+# Per-chunk cap (about 1000 tokens), so one long chunk can't take a whole budget
+MAX_CONTEXT_CHUNK_CHARS = 4000
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; close enough for budgeting
+    return len(text) // 4 + 1
+
+
+_CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+
+def _build_context_text(chunks: List[Dict], token_budget: int) -> str:
+    """Join retrieved chunks, best first, into numbered, relevance-labelled
+    source blocks until token_budget is spent (the first chunk always fits).
+
+    Chunks too distant to help and repeats of a block already included are
+    skipped; long chunks are cut to MAX_CONTEXT_CHUNK_CHARS.
+    """
+    # Header and body fragments go into one list and are joined once, rather
+    # than building a combined string per block first
+    pieces = []
+    included = 0
+    seen = set()
+    used = 0
+    for chunk in chunks:
+        distance = chunk.get('distance', 0)
+        if distance > MAX_CONTEXT_DISTANCE:
+            continue
+        source = chunk['metadata'].get('source', chunk['metadata'].get('unit_name', 'Document'))
+        body = chunk['content']
+        # Overlapping or re-uploaded chunks start the same way
+        fingerprint = (source, body[:200])
+        if fingerprint in seen:
+            continue
+        if len(body) > MAX_CONTEXT_CHUNK_CHARS:
+            body = body[:MAX_CONTEXT_CHUNK_CHARS].rsplit(' ', 1)[0] + "…"
+        cost = _estimate_tokens(body)
+        if included and used + cost > token_budget:
+            break
+        seen.add(fingerprint)
+        used += cost
+        included += 1
+        relevance = _RELEVANCE_LABELS[bisect_right(_RELEVANCE_CUTOFFS, distance)]
+        if included > 1:
+            pieces.append(_CONTEXT_SEPARATOR)
+        pieces.extend(("[Source ", str(included), ": ", source, "] [Relevance: ", relevance, "]\n", body))
+    return "".join(pieces)
+
+
+def _fuse_results(results: Dict, n_results: int, num_queries: int) -> List[Dict]:
+    """Chunks from a multi-query store result, best n_results by reciprocal
+    rank fusion, nearest first.
+
+    ``results`` holds num_queries lists per search, current question first,
+    so lists q with q % num_queries == 0 are the current question's. Only
+    those lists supply chunks and distances; see PREVIOUS_QUERY_WEIGHT for
+    how the previous question's lists count.
+    """
+    if not results or not results.get("documents"):
+        return []
+    scores: Dict[str, float] = {}
+    previous_scores: Dict[str, float] = {}
+    chunks: Dict[str, Dict] = {}
+    for q, docs in enumerate(results["documents"]):
+        ids = results["ids"][q]
+        current = q % num_queries == 0
+        metas = results["metadatas"][q] if results.get("metadatas") else [{}] * len(docs)
+        dists = results["distances"][q] if results.get("distances") else [0] * len(docs)
+        for rank, (chunk_id, doc, meta, distance) in enumerate(zip(ids, docs, metas, dists)):
+            score = 1.0 / (RRF_K + rank + 1)
+            if not current:
+                previous_scores[chunk_id] = previous_scores.get(chunk_id, 0.0) + score
+                continue
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + score
+            known = chunks.get(chunk_id)
+            if known is None or distance < known["distance"]:
+                chunks[chunk_id] = {"content": doc, "metadata": meta, "distance": distance}
+    for chunk_id, score in previous_scores.items():
+        chunk = chunks.get(chunk_id)
+        if chunk is not None and chunk["distance"] <= RELEVANT_DISTANCE:
+            scores[chunk_id] += PREVIOUS_QUERY_WEIGHT * score
+    best = sorted(scores, key=scores.__getitem__, reverse=True)[:n_results]
+    return sorted((chunks[chunk_id] for chunk_id in best), key=lambda chunk: chunk["distance"])
+
+
+def _has_relevant_context(chunks: List[Dict]) -> bool:
+    """Whether any retrieved chunk is close enough to ground an answer.
+
+    Chunks come from retrieve_context nearest first, so only the first is checked.
+    """
+    return bool(chunks) and chunks[0].get('distance', 999) < RELEVANT_DISTANCE
+
+
+class PromptStyle(NamedTuple):
+    """Templates for one way of answering: grounded in the retrieved context,
+    or the general-knowledge fallback when nothing relevant was found."""
+    grounded_system: str
+    grounded_prompt: str
+    fallback_system: str
+    fallback_prompt: str
+
+
+_DETAILED_STYLE = PromptStyle(
+    _GROUNDED_SYSTEM_TMPL, _GROUNDED_PROMPT_TMPL, _FALLBACK_SYSTEM_TMPL, _FALLBACK_PROMPT_TMPL
+)
+_STREAMING_STYLE = PromptStyle(
+    _STREAM_GROUNDED_SYSTEM_TMPL, _STREAM_GROUNDED_PROMPT_TMPL,
+    _STREAM_FALLBACK_SYSTEM_TMPL, _STREAM_FALLBACK_PROMPT_TMPL
+)
+
+
+def _build_prompts(
+    style: PromptStyle,
+    query: str,
+    retrieved_chunks: List[Dict],
+    course_name: str,
+    token_budget: int,
+    length_instruction: str = ""
+) -> Tuple[str, str]:
+    """(system_instruction, prompt) for a query in the given style."""
+    fields = {"query": query, "course_name": course_name, "length_instruction": length_instruction}
+    if _has_relevant_context(retrieved_chunks):
+        context_text = _build_context_text(retrieved_chunks, token_budget)
+        return (
+            style.grounded_system.format(**fields),
+            style.grounded_prompt.format(context_text=context_text, **fields)
+        )
+    logger.debug("No relevant context found; falling back to general knowledge with disclaimer")
+    return style.fallback_system.format(**fields), style.fallback_prompt.format(**fields)
+
+
+class RAGService:
+    
+    async def retrieve_context(
+        self,
+        course_id: int,
+        query: str,
+        session_context: Dict
+    ) -> List[Dict]:
+        """Main retrieval function - simple semantic search.
+
+        The session's previous question, if any, is searched in the same
+        call and helps rank follow-ups ("what about the second one?")
+        towards the material being discussed; grounding and relevance come
+        from the current question's distances alone. When the session is on a unit, that unit's
+        chunks are searched first; the whole course is searched as well only
+        if the unit yields fewer than half of RETRIEVAL_RESULTS.
+        """
+        
+        logger.debug("Retrieving context for query: %.100s...", query)
+        
+        normalized = normalize_query(query)
+        query_texts = [query]
+        previous = session_context.get("previous_query")
+        if previous and normalize_query(previous) != normalized:
+            query_texts.append(previous)
+            previous = normalize_query(previous)
+        else:
+            previous = None
+        n_results = RETRIEVAL_CANDIDATES if previous else RETRIEVAL_RESULTS
+        
+        unit_id = session_context.get("current_unit_id")
+        cache_key = (course_id, normalized, previous, unit_id)
+        chunk_count = await vector_store.count(course_id)
+        cached = _retrieval_cache.get(cache_key)
+        if cached is not None and cached[0] == chunk_count:
+            logger.debug("Serving retrieval from cache")
+            return cached[1]
+        
+        results = None
+        if unit_id:
+            results = await vector_store.query(
+                course_id=course_id,
+                query_text=query_texts,
+                n_results=n_results,
+                where={"unit_id": unit_id}
+            )
+            chunks = _fuse_results(results, RETRIEVAL_RESULTS, len(query_texts))
+        
+        if results is None or len(chunks) < RETRIEVAL_RESULTS // 2:
+            # No unit, or too little in it: plain semantic search over the
+            # course, merged with whatever the unit search found
+            course_results = await vector_store.query(
+                course_id=course_id,
+                query_text=query_texts,
+                n_results=n_results,
+                where=None
+            )
+            if results is not None:
+                course_results = {
+                    key: (results.get(key) or []) + (course_results.get(key) or [])
+                    for key in ("ids", "documents", "metadatas", "distances")
+                }
+            chunks = _fuse_results(course_results, RETRIEVAL_RESULTS, len(query_texts))
+        
+        logger.debug("Retrieved %d chunks for %d queries", len(chunks), len(query_texts))
+        _retrieval_cache[cache_key] = (chunk_count, chunks)
+        return chunks
+    
+    async def generate_response(
+        self,
+        query: str,
+        retrieved_chunks: List[Dict],
+        session_context: Dict,
+        course_name: str
+    ) -> str:
+        """Generate response using retrieved context with strict grounding."""
+
+        logger.debug("Generating response for: %.100s... (%d context chunks)", query, len(retrieved_chunks))
+
+        words = _WORD_RE.findall(query.lower())
+        tokens = set(words)
+        is_simple_query = len(words) < 10 and tokens.isdisjoint(_COMPLEX_QUERY_WORDS)
+        is_comprehensive_query = not tokens.isdisjoint(_COMPREHENSIVE_QUERY_WORDS)
+
+        if is_simple_query:
+            token_budget = SIMPLE_CONTEXT_TOKENS
+            length_instruction = "Keep your answer concise - 2-3 sentences for simple factual questions."
+        elif is_comprehensive_query:
+            token_budget = COMPREHENSIVE_CONTEXT_TOKENS
+            length_instruction = "Provide a thorough answer with examples, but only from the provided sources."
+        else:
+            token_budget = CONTEXT_TOKENS
+            length_instruction = "Match response length to question complexity. Be thorough but not verbose."
+
+        system_instruction, prompt = _build_prompts(
+            _DETAILED_STYLE, query, retrieved_chunks, course_name, token_budget, length_instruction
+        )
+
+        logger.debug("Sending prompt to Gemini (length: %d)", len(prompt))
         response = await gemini_service.generate_text(prompt, system_instruction)
-        logger.info(f"Generated response (length: {len(response)})")
+        logger.debug("Generated response (length: %d)", len(response))
         return response
     
     async def generate_streaming_response(
@@ -154,39 +353,9 @@ Answer using general knowledge with the required disclaimer."""
     ):
         """Generate streaming response with grounded prompt."""
 
-        if retrieved_chunks:
-            context_parts = []
-            for i, chunk in enumerate(retrieved_chunks[:6], 1):
-                source = chunk['metadata'].get('source', chunk['metadata'].get('unit_name', 'Document'))
-                distance = chunk.get('distance', 0)
-                relevance = "HIGH" if distance < 0.5 else "MEDIUM" if distance < 1.0 else "LOW"
-                context_parts.append(
-                    f"[Source {i}: {source}] [Relevance: {relevance}]\n{chunk['content']}"
-                )
-            context_text = "\n\n---\n\n".join(context_parts)
-        else:
-            context_text = "NO CONTEXT AVAILABLE"
-
-        has_relevant_context = False
-        if retrieved_chunks:
-            min_distance = min(chunk.get('distance', 999) for chunk in retrieved_chunks)
-            has_relevant_context = min_distance < 1.2 and len(retrieved_chunks) > 0
-
-        if has_relevant_context:
-            system_instruction = f"""You are an AI tutor for: {course_name}.
-Use ONLY the provided context blocks. Cite sources (Source 1, Source 2...). If context seems weak, say so and avoid guessing."""
-
-            prompt = f"""## Student's Study Materials:
-{context_text}
----
-## Student's Question: "{query}"
-Stream a grounded answer. If unsure, say so explicitly."""
-        else:
-            system_instruction = f"""You are an AI tutor helping with: {course_name}.
-The uploaded materials don't cover this; respond with general knowledge and a clear disclaimer."""
-
-            prompt = f"""Student's Question: "{query}"
-No relevant uploaded context found. Start with the disclaimer, then answer concisely."""
+        system_instruction, prompt = _build_prompts(
+            _STREAMING_STYLE, query, retrieved_chunks, course_name, CONTEXT_TOKENS
+        )
 
         async for chunk in gemini_service.generate_streaming(prompt, system_instruction):
             yield chunk
@@ -0,0 +1,59 @@
+"""Task queue client - hands background jobs to the arq worker (app.worker)"""
+from typing import Optional
+
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+from fastapi import BackgroundTasks
+
+from app.core.config import settings
+from app.utils.logging_config import get_logger
+
+logger = get_logger("task_queue")
+
+_redis_pool: Optional[ArqRedis] = None
+
+
+def redis_settings() -> RedisSettings:
+    return RedisSettings.from_dsn(settings.REDIS_URL)
+
+
+async def get_redis_pool() -> ArqRedis:
+    """Connect to Redis on first use and reuse the pool afterwards."""
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = await create_pool(redis_settings())
+    return _redis_pool
+
+
+def worker_enabled() -> bool:
+    """Whether jobs can run in the worker process.
+
+    Embedded Chroma (PersistentClient on CHROMA_DIR) supports a single
+    process only, so the worker is used only with Redis configured and a
+    vector store other processes can write to: FAISS or a Chroma server.
+    """
+    if not settings.REDIS_URL:
+        return False
+    return settings.VECTOR_BACKEND == "faiss" or bool(settings.CHROMA_HOST)
+
+
+async def enqueue_job(background_tasks: BackgroundTasks, func, *args) -> None:
+    """Queue ``func(*args)`` on the worker, keyed by the function's name.
+
+    When the worker can't be used (no REDIS_URL, or embedded Chroma) the job
+    falls back to an in-process FastAPI background task.
+    """
+    if not worker_enabled():
+        background_tasks.add_task(func, *args)
+        return
+
+    pool = await get_redis_pool()
+    await pool.enqueue_job(func.__name__, *args)
+
+
+async def close_task_queue() -> None:
+    """Close the Redis pool, if it was opened."""
+    global _redis_pool
+    if _redis_pool is not None:
+        await _redis_pool.close()
+        _redis_pool = None
@@ -1,103 +1,545 @@
 import chromadb
 from chromadb.config import Settings
 import os
-from typing import List, Dict
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import List, Dict, Optional, Tuple, Union
+from app.core.config import settings
 from app.services.gemini_service import gemini_service
 import asyncio
+import re
+import sqlite3
+import threading
+import numpy as np
+import orjson
+
+try:
+    # Only needed with VECTOR_BACKEND=faiss
+    import faiss
+except ImportError:  # pragma: no cover - Chroma backend only
+    faiss = None
+
+# Texts per embed_content request (the embedding API accepts up to 100)
+EMBED_BATCH_SIZE = 100
+# Embedding requests in flight across all documents being processed
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+_embed_slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+# Chroma buffers new vectors and folds them into the HNSW graph every
+# hnsw:batch_size adds, persisting every hnsw:sync_threshold. Matching the
+# buffer to one ingest write means each write updates the index once rather
+# than every 100 vectors. Only applied when a collection is created.
+HNSW_BULK_PARAMS = {
+    "hnsw:batch_size": settings.INGEST_BATCH_SIZE,
+    "hnsw:sync_threshold": max(1000, 4 * settings.INGEST_BATCH_SIZE),
+}
+
+# Vector-store calls block on SQLite and index traversal, so they run on a
+# small dedicated pool: the event loop stays free, and concurrent requests
+# queue here rather than on SQLite's single writer lock
+STORE_THREADS = int(os.getenv("VECTOR_STORE_THREADS", "4"))
+_store_executor = ThreadPoolExecutor(max_workers=STORE_THREADS, thread_name_prefix="vector-store")
+
+# FAISS backend: indexes switch from exact search to HNSW above this size
+FAISS_HNSW_THRESHOLD = int(os.getenv("FAISS_HNSW_THRESHOLD", "100000"))
+# In-memory vector encoding for FAISS indexes: "fp16" (default, half the
+# memory of fp32), "int8" (a quarter, slightly lossier) or "fp32".
+# Vectors on disk stay float32, so this can be changed at any restart
+FAISS_QUANTIZATION = os.getenv("FAISS_QUANTIZATION", "fp16")
+_SQ_TYPES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+} if faiss is not None else {}
+
+# Metadata keys retrieval filters on; FAISS chunk files index them so a
+# where prefilter is an index lookup rather than a scan of every row
+FAISS_INDEXED_METADATA = ("unit_id", "source")
+_METADATA_KEY_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Query embeddings by normalized query text. Kept apart from the embedding
+# LRU in gemini_service, which ingestion cycles through in bulk
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "2048"))
+_query_embeddings: LRUCache = LRUCache(maxsize=QUERY_EMBED_CACHE_SIZE)
+
+
+def normalize_query(query_text: str) -> str:
+    # Case and spacing don't change what is being asked
+    return " ".join(query_text.split()).casefold()
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Run a blocking vector-store call (SQLite, index search) on the store's thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_store_executor, partial(fn, *args, **kwargs))
+
+
+async def _embed(texts: List[str]) -> List[List[float]]:
+    """One embedding request, bounded by EMBED_CONCURRENCY."""
+    async with _embed_slots:
+        return await gemini_service.generate_embeddings(texts)
+
+
+async def _fill_embeddings(
+    documents: List[str],
+    embeddings: Optional[List[Optional[List[float]]]]
+) -> List[List[float]]:
+    """Vectors for ``documents``: the given ones, with None entries generated
+    in concurrent API-sized requests."""
+    filled = list(embeddings) if embeddings is not None else [None] * len(documents)
+    missing = [j for j, embedding in enumerate(filled) if embedding is None]
+    if missing:
+        generated = await asyncio.gather(*[
+            _embed([documents[j] for j in missing[k:k + EMBED_BATCH_SIZE]])
+            for k in range(0, len(missing), EMBED_BATCH_SIZE)
+        ])
+        for j, embedding in zip(missing, chain.from_iterable(generated)):
+            filled[j] = embedding
+    return filled
+
+
+async def _query_embeddings_for(query_texts: List[str]) -> List[List[float]]:
+    """Embeddings of search queries, reusing them for repeated questions;
+    the ones not cached are requested together. Only the cache key is
+    normalized; the text is embedded as written, like the stored chunks."""
+    normalized = [normalize_query(text) for text in query_texts]
+    embeddings = [_query_embeddings.get(text) for text in normalized]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        generated = await gemini_service.generate_embeddings([query_texts[i] for i in missing])
+        for i, embedding in zip(missing, generated):
+            embeddings[i] = embedding
+            _query_embeddings[normalized[i]] = embedding
+    return embeddings
+
 
 class VectorStore:
     def __init__(self):
-        self.client = chromadb.PersistentClient(
-            path=os.getenv("CHROMA_DIR", "./storage/chroma_db"),
-            settings=Settings(anonymized_telemetry=False)
-        )
+        if settings.CHROMA_HOST:
+            self.client = chromadb.HttpClient(
+                host=settings.CHROMA_HOST,
+                port=settings.CHROMA_PORT,
+                settings=Settings(anonymized_telemetry=False)
+            )
+        else:
+            self.client = chromadb.PersistentClient(
+                path=os.getenv("CHROMA_DIR", "./storage/chroma_db"),
+                settings=Settings(anonymized_telemetry=False)
+            )
+        # Collection handles by course, so lookups skip Chroma's catalog
+        self._collections: Dict[int, "chromadb.Collection"] = {}
     
     def get_or_create_collection(self, course_id: int):
-        """Get or create collection for a course"""
-        collection_name = f"course_{course_id}"
-        return self.client.get_or_create_collection(
-            name=collection_name,
-            metadata={"course_id": str(course_id)}
-        )
+        """Get or create collection for a course (handles are cached per course)"""
+        collection = self._collections.get(course_id)
+        if collection is None:
+            collection = self.client.get_or_create_collection(
+                name=f"course_{course_id}",
+                metadata={"course_id": str(course_id), **HNSW_BULK_PARAMS}
+            )
+            self._collections[course_id] = collection
+        return collection
+    
+    def _get_collection(self, course_id: int):
+        """Existing collection for a course, or None; does not create one."""
+        collection = self._collections.get(course_id)
+        if collection is None:
+            try:
+                collection = self.client.get_collection(f"course_{course_id}")
+            except Exception:
+                return None
+            self._collections[course_id] = collection
+        return collection
     
-    async def add_documents(
-        self, 
-        course_id: int, 
-        documents: List[str], 
-        metadatas: List[Dict],
-        ids: List[str]
-    ):
-        """Add documents to vector store"""
-        collection = self.get_or_create_collection(course_id)
-        
-        # Generate embeddings
-        embeddings = []
-        for doc in documents:
-            embedding = await gemini_service.generate_embedding(doc)
-            embeddings.append(embedding)
-        
-        # Add to collection
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            embeddings=embeddings,
-            ids=ids
-        )
-
     async def add_documents_batched(
         self,
         course_id: int,
         documents: List[str],
         metadatas: List[Dict],
         ids: List[str],
-        batch_size: int = 10
+        batch_size: int = settings.INGEST_BATCH_SIZE,
+        embeddings: Optional[List[Optional[List[float]]]] = None
     ):
-        """Add documents with batched embedding generation for throughput."""
-        collection = self.get_or_create_collection(course_id)
+        """Add documents in writes of ``batch_size``, embedding in API-sized requests.
+
+        ``embeddings`` may carry precomputed vectors aligned with ``documents``;
+        entries left as None are generated.
+        """
+        collection = await _run_blocking(self.get_or_create_collection, course_id)
 
         for i in range(0, len(documents), batch_size):
             batch_docs = documents[i:i + batch_size]
             batch_metas = metadatas[i:i + batch_size]
             batch_ids = ids[i:i + batch_size]
 
-            embeddings = await asyncio.gather(*[
-                gemini_service.generate_embedding(doc) for doc in batch_docs
-            ])
+            batch_embeddings = await _fill_embeddings(
+                batch_docs,
+                embeddings[i:i + batch_size] if embeddings is not None else None
+            )
 
-            collection.add(
+            await _run_blocking(
+                collection.add,
                 documents=batch_docs,
                 metadatas=batch_metas,
-                embeddings=embeddings,
+                embeddings=batch_embeddings,
                 ids=batch_ids
             )
+
+    async def count(self, course_id: int) -> int:
+        """Number of chunks stored for a course (0 if it has no collection)."""
+        return await _run_blocking(self._count, course_id)
+    
+    def _count(self, course_id: int) -> int:
+        collection = self._get_collection(course_id)
+        return collection.count() if collection is not None else 0
+    
+    async def warm_up(self, course_ids: List[int]) -> None:
+        """Open the courses' collections and load their HNSW indexes, so the
+        first question about each doesn't pay for it."""
+        for course_id in course_ids:
+            await _run_blocking(self._warm_up, course_id)
+    
+    def _warm_up(self, course_id: int) -> None:
+        collection = self._get_collection(course_id)
+        if collection is None:
+            return
+        # Any search loads the index; a stored vector is a query of the right size
+        sample = collection.get(limit=1, include=["embeddings"])
+        if sample["embeddings"] is not None and len(sample["embeddings"]):
+            collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1)
     
     async def query(
         self,
         course_id: int,
-        query_text: str,
+        query_text: Union[str, List[str]],
         n_results: int = 5,
         where: Dict = None
     ) -> Dict:
-        """Query vector store"""
-        collection = self.get_or_create_collection(course_id)
+        """Query vector store; a list of queries is searched in one call,
+        with one inner result list per query."""
+        collection = await _run_blocking(self.get_or_create_collection, course_id)
         
-        # Generate query embedding
-        query_embedding = await gemini_service.generate_embedding(query_text)
+        query_texts = [query_text] if isinstance(query_text, str) else query_text
+        query_embeddings = await _query_embeddings_for(query_texts)
         
         # Query collection
-        results = collection.query(
-            query_embeddings=[query_embedding],
+        return await _run_blocking(
+            collection.query,
+            query_embeddings=query_embeddings,
             n_results=n_results,
             where=where
         )
-        
-        return results
     
     def delete_collection(self, course_id: int):
         """Delete a course collection"""
+        self._collections.pop(course_id, None)
         try:
             self.client.delete_collection(f"course_{course_id}")
         except:
             pass
 
-vector_store = VectorStore()
+class FAISSVectorStore:
+    """Exact-search vector store with the same interface as VectorStore.
+
+    Each course has a SQLite file holding its chunks (text, metadata, float32
+    vector), which is the source of truth and what the worker process writes.
+    Searches run against an in-memory FAISS index built from that file on
+    first use and topped up with rows added since. The index is brute-force
+    L2 up to FAISS_HNSW_THRESHOLD vectors, then HNSW, with vectors held
+    scalar-quantized per FAISS_QUANTIZATION. Vectors and queries are
+    stored and searched at unit length. Gemini embeddings already have unit
+    length, so distances are the same squared L2 as Chroma's default space
+    and the relevance cutoffs in rag_service apply unchanged.
+    """
+
+    def __init__(self):
+        if faiss is None:
+            raise RuntimeError("VECTOR_BACKEND=faiss requires the faiss-cpu package")
+        self.root = settings.FAISS_DIR
+        os.makedirs(self.root, exist_ok=True)
+        # course_id -> (index, highest row_id it contains)
+        self._indexes: Dict[int, Tuple["faiss.Index", int]] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, course_id: int) -> str:
+        return os.path.join(self.root, f"course_{course_id}.db")
+
+    def _connect(self, course_id: int, create: bool = False) -> Optional[sqlite3.Connection]:
+        """Open a course's chunk file; None if it doesn't exist and create is False."""
+        path = self._path(course_id)
+        if not create and not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(path)
+        if create:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "row_id INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+                "document TEXT, metadata TEXT, embedding BLOB NOT NULL)"
+            )
+            for key in FAISS_INDEXED_METADATA:
+                # Same expression as _where_sql emits, so SQLite can use it
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS ix_chunks_{key} ON chunks ({_metadata_expr(key)})"
+                )
+        return conn
+
+    async def add_documents_batched(
+        self,
+        course_id: int,
+        documents: List[str],
+        metadatas: List[Dict],
+        ids: List[str],
+        batch_size: int = settings.INGEST_BATCH_SIZE,
+        embeddings: Optional[List[Optional[List[float]]]] = None
+    ):
+        """Add documents in writes of ``batch_size``; see VectorStore.add_documents_batched."""
+        for i in range(0, len(documents), batch_size):
+            batch_docs = documents[i:i + batch_size]
+            batch_embeddings = await _fill_embeddings(
+                batch_docs,
+                embeddings[i:i + batch_size] if embeddings is not None else None
+            )
+            await _run_blocking(
+                self._add,
+                course_id,
+                batch_docs,
+                metadatas[i:i + batch_size],
+                ids[i:i + batch_size],
+                batch_embeddings
+            )
+
+    def _add(self, course_id, documents, metadatas, ids, embeddings) -> None:
+        rows = [
+            (doc_id, document, orjson.dumps(metadata).decode(), _pack_vector(embedding))
+            for doc_id, document, metadata, embedding in zip(ids, documents, metadatas, embeddings)
+        ]
+        conn = self._connect(course_id, create=True)
+        try:
+            with conn:
+                # Like Chroma's add, ids already present are left as they are
+                conn.executemany(
+                    "INSERT OR IGNORE INTO chunks (id, document, metadata, embedding) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+        finally:
+            conn.close()
+
+    async def count(self, course_id: int) -> int:
+        """Number of chunks stored for a course (0 if it has none)."""
+        return await _run_blocking(self._count, course_id)
+
+    def _count(self, course_id: int) -> int:
+        conn = self._connect(course_id)
+        if conn is None:
+            return 0
+        try:
+            return conn.execute("SELECT count(*) FROM chunks").fetchone()[0]
+        finally:
+            conn.close()
+
+    async def warm_up(self, course_ids: List[int]) -> None:
+        """Build the courses' in-memory indexes ahead of their first query."""
+        for course_id in course_ids:
+            await _run_blocking(self._warm_up, course_id)
+
+    def _warm_up(self, course_id: int) -> None:
+        conn = self._connect(course_id)
+        if conn is None:
+            return
+        try:
+            with self._lock:
+                self._refresh_index(course_id, conn)
+        finally:
+            conn.close()
+
+    async def query(
+        self,
+        course_id: int,
+        query_text: Union[str, List[str]],
+        n_results: int = 5,
+        where: Dict = None
+    ) -> Dict:
+        """Query vector store; results are shaped like Chroma's, one inner
+        list per query when a list of queries is given."""
+        query_texts = [query_text] if isinstance(query_text, str) else query_text
+        query_embeddings = await _query_embeddings_for(query_texts)
+        return await _run_blocking(self._search, course_id, query_embeddings, n_results, where)
+
+    def _search(self, course_id: int, query_embeddings, n_results: int, where: Optional[Dict]) -> Dict:
+        conn = self._connect(course_id)
+        if conn is None:
+            empty = [[] for _ in query_embeddings]
+            return {"ids": empty, "documents": empty, "metadatas": empty, "distances": empty}
+        try:
+            queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+            if where:
+                # Metadata filters narrow the rows in SQLite, then that subset
+                # is scored exactly
+                clauses, params = _where_sql(where)
+                rows = conn.execute(f"SELECT row_id, embedding FROM chunks WHERE {clauses}", params).fetchall()
+                found = []
+                if rows:
+                    row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                    vectors = _unpack_vector(b"".join(row[1] for row in rows)).reshape(len(rows), -1)
+                    for query in queries:
+                        distances = _l2_distances(vectors, query)
+                        order = _top_k(distances, n_results)
+                        found.append(list(zip(row_ids[order].tolist(), distances[order].tolist())))
+                else:
+                    found = [[] for _ in queries]
+            else:
+                with self._lock:
+                    index = self._refresh_index(course_id, conn)
+                    if index is None or index.ntotal == 0:
+                        found = [[] for _ in queries]
+                    else:
+                        # All queries go to the index in one search call
+                        distances, labels = index.search(queries, min(n_results, index.ntotal))
+                        found = [
+                            [
+                                (int(label), float(distance))
+                                for label, distance in zip(query_labels, query_distances) if label != -1
+                            ]
+                            for query_labels, query_distances in zip(labels, distances)
+                        ]
+
+            by_row = {}
+            row_ids = list({row_id for hits in found for row_id, _ in hits})
+            if row_ids:
+                by_row = {
+                    row[0]: row[1:] for row in conn.execute(
+                        f"SELECT row_id, id, document, metadata FROM chunks "
+                        f"WHERE row_id IN ({','.join('?' * len(row_ids))})", row_ids
+                    )
+                }
+        finally:
+            conn.close()
+
+        per_query = [
+            [(by_row[row_id], distance) for row_id, distance in hits if row_id in by_row]
+            for hits in found
+        ]
+        return {
+            "ids": [[row[0] for row, _ in hits] for hits in per_query],
+            "documents": [[row[1] for row, _ in hits] for hits in per_query],
+            "metadatas": [[orjson.loads(row[2]) for row, _ in hits] for hits in per_query],
+            "distances": [[distance for _, distance in hits] for hits in per_query],
+        }
+
+    def _refresh_index(self, course_id: int, conn: sqlite3.Connection):
+        """The course's index, with rows written since it was built added. Call under _lock."""
+        index, last_row_id = self._indexes.get(course_id, (None, 0))
+        rows = conn.execute(
+            "SELECT row_id, embedding FROM chunks WHERE row_id > ? ORDER BY row_id", (last_row_id,)
+        ).fetchall()
+        if not rows:
+            return index
+
+        row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        vectors = _unpack_vector(b"".join(row[1] for row in rows)).reshape(len(rows), -1)
+        if index is not None and vectors.shape[1] != index.d:
+            # Rows embedded by a different model can't share the index
+            raise ValueError(
+                f"course {course_id}: new vectors have {vectors.shape[1]} dimensions, index has {index.d}"
+            )
+        total = len(rows) + (index.ntotal if index is not None else 0)
+
+        if index is None or (total > FAISS_HNSW_THRESHOLD and not _is_hnsw(index)):
+            if index is not None:
+                # Crossing the threshold: rebuild everything as HNSW
+                rows = conn.execute("SELECT row_id, embedding FROM chunks ORDER BY row_id").fetchall()
+                row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                vectors = _unpack_vector(b"".join(row[1] for row in rows)).reshape(len(rows), -1)
+            index = _new_index(vectors, hnsw=total > FAISS_HNSW_THRESHOLD)
+
+        index.add_with_ids(vectors, row_ids)
+        self._indexes[course_id] = (index, int(row_ids[-1]))
+        return index
+
+    def delete_collection(self, course_id: int):
+        """Delete a course's chunks and its in-memory index."""
+        with self._lock:
+            self._indexes.pop(course_id, None)
+        path = self._path(course_id)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Rows scaled to unit length, in place."""
+    vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True) + 1e-12
+    return vectors
+
+
+def _pack_vector(embedding) -> bytes:
+    return _normalize(np.array(embedding, dtype=np.float32)).tobytes()
+
+
+def _unpack_vector(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+def _l2_distances(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Squared L2 distance of each unit-length row to a unit-length query,
+    2 - 2 v.q; the dot products are one BLAS matrix-vector product."""
+    distances = 2.0 - 2.0 * (vectors @ query)
+    # Rounding can take exact matches slightly below zero
+    return np.maximum(distances, 0.0, out=distances)
+
+
+def _top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k smallest distances, nearest first."""
+    if k < len(distances):
+        candidates = np.argpartition(distances, k)[:k]
+        return candidates[np.argsort(distances[candidates])]
+    return np.argsort(distances)
+
+
+def _new_index(vectors: np.ndarray, hnsw: bool):
+    """Empty id-mapped index for vectors like these, stored as FAISS_QUANTIZATION says."""
+    dim = vectors.shape[1]
+    qtype = _SQ_TYPES.get(FAISS_QUANTIZATION) if faiss is not None else None
+    if qtype is None:
+        inner = faiss.IndexHNSWFlat(dim, 32) if hnsw else faiss.IndexFlatL2(dim)
+    else:
+        inner = faiss.IndexHNSWSQ(dim, qtype, 32) if hnsw else faiss.IndexScalarQuantizer(dim, qtype)
+        # int8 learns per-dimension ranges from the vectors present at build
+        # time; fp16 needs no training
+        inner.train(vectors)
+    return faiss.IndexIDMap(inner)
+
+
+def _is_hnsw(index) -> bool:
+    return isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW)
+
+
+def _metadata_expr(key: str) -> str:
+    """SQL reading one metadata key. The path is inlined, not bound, so it
+    matches the expression indexes on FAISS_INDEXED_METADATA."""
+    if not _METADATA_KEY_RE.match(key):
+        raise ValueError(f"Unsupported metadata key: {key!r}")
+    return f"json_extract(metadata, '$.{key}')"
+
+
+def _where_sql(where: Dict) -> Tuple[str, list]:
+    """SQL for a Chroma-style equality filter: {"key": value} or {"key": {"$eq": value}}."""
+    clauses, params = [], []
+    for key, condition in where.items():
+        if isinstance(condition, dict):
+            if set(condition) != {"$eq"}:
+                raise ValueError(f"Unsupported where operator for {key}: {condition}")
+            condition = condition["$eq"]
+        clauses.append(f"{_metadata_expr(key)} = ?")
+        params.append(condition)
+    return " AND ".join(clauses), params
+
+
+if settings.VECTOR_BACKEND == "faiss":
+    vector_store = FAISSVectorStore()
+else:
+    vector_store = VectorStore()
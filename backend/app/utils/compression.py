@@ -0,0 +1,37 @@
+"""zstd helpers for large text stored in the database"""
+import threading
+from typing import Optional
+
+import zstandard
+
+# Level 6 keeps natural-language text at roughly a third of its size while
+# compressing well above upload speeds
+_COMPRESSION_LEVEL = 6
+
+# zstd contexts are not thread-safe and uploads compress from worker threads,
+# so each thread keeps its own pair
+_local = threading.local()
+
+
+def _compressor() -> zstandard.ZstdCompressor:
+    compressor = getattr(_local, "compressor", None)
+    if compressor is None:
+        compressor = _local.compressor = zstandard.ZstdCompressor(level=_COMPRESSION_LEVEL)
+    return compressor
+
+
+def _decompressor() -> zstandard.ZstdDecompressor:
+    decompressor = getattr(_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+def compress_text(text: str) -> bytes:
+    return _compressor().compress(text.encode("utf-8"))
+
+
+def decompress_text(blob: Optional[bytes]) -> str:
+    if not blob:
+        return ""
+    return _decompressor().decompress(blob).decode("utf-8")
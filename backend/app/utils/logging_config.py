@@ -1,5 +1,8 @@
+import atexit
 import logging
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from pathlib import Path
 from datetime import datetime
 
@@ -14,22 +17,29 @@ log_filename = LOG_DIR / f"backend_{datetime.now().strftime('%Y%m%d')}.log"
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-# Create handlers
+# Create handlers (sharing one formatter)
+formatter = logging.Formatter(LOG_FORMAT, DATE_FORMAT)
+
 file_handler = logging.FileHandler(log_filename)
 file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+file_handler.setFormatter(formatter)
 
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
-
-# Configure root logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format=LOG_FORMAT,
-    datefmt=DATE_FORMAT,
-    handlers=[file_handler, console_handler]
-)
+console_handler.setFormatter(formatter)
+
+# Loggers only enqueue records; a background thread does the file and
+# console writes, so logging never blocks the event loop on I/O
+log_queue: Queue = Queue(-1)
+queue_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)  # flush queued records on exit
+
+# Configure root logger; the queue handler only merges args into the
+# message, and the listener's handlers apply LOG_FORMAT
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.DEBUG, handlers=[queue_handler])
 
 # Create logger for the app
 logger = logging.getLogger("rag_education")
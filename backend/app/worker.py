@@ -0,0 +1,35 @@
+"""arq worker for document processing
+
+Run with: arq app.worker.WorkerSettings
+
+Requires a vector store shared between processes (VECTOR_BACKEND=faiss or
+CHROMA_HOST); with embedded Chroma the API ingests uploads itself.
+"""
+from typing import List
+
+from arq import func
+
+from app.api.courses import process_documents_background
+from app.core.config import settings
+from app.services.task_queue import redis_settings, worker_enabled
+
+
+async def _startup(ctx):
+    if not worker_enabled():
+        raise RuntimeError(
+            "The worker needs REDIS_URL and VECTOR_BACKEND=faiss or CHROMA_HOST; "
+            "embedded Chroma can't be opened by a second process"
+        )
+
+
+async def _process_documents(ctx, file_ids: List[int], course_id: int, unit_id: int, course_name: str):
+    await process_documents_background(file_ids, course_id, unit_id, course_name)
+
+
+class WorkerSettings:
+    functions = [func(_process_documents, name=process_documents_background.__name__)]
+    redis_settings = redis_settings()
+    on_startup = _startup
+    # Jobs mostly wait on remote Gemini embedding calls (I/O-bound), so size
+    # this to the API concurrency available (GEMINI_MAX_CONCURRENCY), not CPUs
+    max_jobs = settings.WORKER_MAX_JOBS